@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import datetime
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from util import str2timestamp
+from bill import WeChatBill
+from bill_file import BillFile
+from bill_item import BillType, ClassifyAlg
+from category import ExpenseCategory
+from matcher import SubstringMatcher
+from classifier_local import NaiveBayesClassifier, UNTRAINED_CATEGORIES
+from example_index import ExampleIndex
+
+def timeit(func, repeat=3):
+    """返回 func 多次运行中最快一次的耗时（秒）"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        cost = time.perf_counter() - start
+        if best is None or cost < best:
+            best = cost
+    return best
+
+def bench_str2timestamp(size=100000):
+    """对比 strptime 与固定位置解析 str2timestamp 的耗时"""
+    random.seed(0)
+    start = datetime.datetime(2023, 1, 1)
+    time_list = []
+    for _ in range(size):
+        dt = start + datetime.timedelta(seconds=random.randint(0, 86400 * 365))
+        time_list.append((dt.strftime("%Y-%m-%d %H:%M:%S"), "%Y-%m-%d %H:%M:%S"))
+        time_list.append((dt.strftime("%Y/%m/%d %H:%M"), "%Y/%m/%d %H:%M"))
+
+    def run_strptime():
+        return [datetime.datetime.strptime(s, f).timestamp() for s, f in time_list]
+
+    def run_fast():
+        return [str2timestamp(s, f) for s, f in time_list]
+
+    assert run_strptime() == run_fast()
+
+    base_cost = timeit(run_strptime)
+    fast_cost = timeit(run_fast)
+    print("str2timestamp rows:{}".format(len(time_list)))
+    print("  strptime: {:.3f}s".format(base_cost))
+    print("  fast    : {:.3f}s ({:.1f}x)".format(fast_cost, base_cost / fast_cost))
+
+def write_fake_wechat_csv(file_path, size):
+    """写入 size 行模拟的微信账单导出文件"""
+    random.seed(0)
+    start = datetime.datetime(2023, 1, 1)
+    with open(file_path, 'w', encoding='utf-8') as f:
+        f.write("微信支付账单明细\n")
+        f.write("----------------------微信支付账单明细列表--------------------\n")
+        f.write("交易时间,交易类型,交易对方,商品,收/支,金额(元),支付方式,当前状态,交易单号,商户单号,备注\n")
+        for i in range(size):
+            bill_time = start + datetime.timedelta(minutes=size - i)
+            f.write("{},商户消费,商家{},商品{},支出,¥{:.2f},零钱,支付成功,4200{:012d}\t,,/\n".format(
+                bill_time.strftime("%Y-%m-%d %H:%M:%S"), random.randrange(500), random.randrange(2000),
+                random.randint(1, 99999) / 100, i))
+
+class LegacyBillItem:
+    """改为 __slots__ 之前的 BillItem，作为内存对比的基准"""
+    def __init__(self, amount, payee, item_name, bill_type, order_id, bill_time, bill_source="unknown", owner=""):
+        self.amount = amount
+        self.payee = payee
+        self.item_name = item_name
+        self.bill_type = bill_type
+        self.order_id = order_id
+        self.bill_time = bill_time
+        self.bill_source = bill_source
+        self.owner = owner
+        self.category = ExpenseCategory.UNKNOWN
+        self.classify_alg = ClassifyAlg.UNKNOWN
+
+def measure_memory(func):
+    """返回 (func 的返回值, 返回值占用的内存字节数)"""
+    tracemalloc.start()
+    result = func()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size
+
+def bench_bill_item(size=500000):
+    """解析模拟的微信账单，对比旧 BillItem 与 __slots__ + intern 的 BillItem 的内存占用"""
+    fd, file_path = tempfile.mkstemp(suffix='.csv')
+    os.close(fd)
+    try:
+        write_fake_wechat_csv(file_path, size)
+        bill = WeChatBill(BillFile(file_path, "owner", "wechat"))
+
+        def parse_legacy():
+            # 与 WeChatBill.parse_row 相同的字段，但不做 intern
+            return [LegacyBillItem(float(row[5].lstrip(chr(165))), row[2], row[3], BillType.EXPENSE, row[8],
+                                   str2timestamp(row[0], "%Y-%m-%d %H:%M:%S"), "wechat", bill.owner)
+                    for row in bill.iter_bill_rows()]
+
+        _, legacy_size = measure_memory(parse_legacy)
+        _, slots_size = measure_memory(lambda: list(bill.iter_items()))
+    finally:
+        os.remove(file_path)
+
+    print("bill item rows:{}".format(size))
+    print("  dict BillItem          : {:.1f} MB ({:.0f} B/item)".format(legacy_size / 1024 / 1024, legacy_size / size))
+    print("  slots + intern BillItem: {:.1f} MB ({:.0f} B/item, {:.1f}x)".format(
+        slots_size / 1024 / 1024, slots_size / size, legacy_size / slots_size))
+
+def bench_substring_matcher(size=100000, rule_size=5000, naive_size=2000):
+    """对比逐条规则判断子串与 Aho-Corasick 自动机的模糊匹配耗时
+
+    逐条规则的方式太慢，只在前 naive_size 条账单上运行，再按条数折算
+    """
+    random.seed(0)
+    # 常用汉字区间中的 300 个字符
+    chars = [chr(0x4e00 + i) for i in range(300)]
+    rule_dict = {}
+    while len(rule_dict) < rule_size:
+        rule = "".join(random.choice(chars) for _ in range(random.randint(2, 5)))
+        rule_dict[rule] = random.choice(list(ExpenseCategory))
+    rules = list(rule_dict)
+    text_list = []
+    for _ in range(size):
+        text = "".join(random.choice(chars) for _ in range(random.randint(8, 30)))
+        if random.random() < 0.3:
+            text = text + random.choice(rules)
+        text_list.append(text)
+
+    def match_naive(texts):
+        results = []
+        for text in texts:
+            result = None
+            for rule, category in rule_dict.items():
+                if rule in text:
+                    result = category
+                    break
+            results.append(result)
+        return results
+
+    matcher = None
+
+    def build():
+        nonlocal matcher
+        matcher = SubstringMatcher(rule_dict)
+
+    build_cost = timeit(build, repeat=1)
+    naive_texts = text_list[:naive_size]
+    assert match_naive(naive_texts) == [matcher.match(text) for text in naive_texts]
+
+    naive_cost = timeit(lambda: match_naive(naive_texts), repeat=1) * size / len(naive_texts)
+    matcher_cost = timeit(lambda: [matcher.match(text) for text in text_list], repeat=1)
+    print("substring matcher rules:{} items:{}".format(rule_size, size))
+    print("  naive loop : {:.3f}s (按 {} 条折算)".format(naive_cost, len(naive_texts)))
+    print("  automaton  : {:.3f}s + build {:.3f}s ({:.1f}x)".format(matcher_cost, build_cost, naive_cost / matcher_cost))
+
+def bench_local_classifier(size=20000, test_size=5000, threshold=0.9):
+    """本地朴素贝叶斯模型的训练、预测耗时，以及见过和没见过的商家中达到阈值的账单比例和准确率"""
+    random.seed(0)
+    chars = [chr(0x4e00 + i) for i in range(300)]
+    categories = [category.value for category in ExpenseCategory if category not in UNTRAINED_CATEGORIES]
+
+    # 每个商家有 1~3 个常见分类（超市等综合商家有多个），商品名由商家名和随机字符组成
+    def make_merchants(count):
+        merchants = []
+        for _ in range(count):
+            name = "".join(random.choice(chars) for _ in range(random.randint(3, 8)))
+            merchants.append((name, random.sample(categories, random.choice([1, 1, 2, 3]))))
+        return merchants
+
+    def make_samples(merchants, count):
+        samples = []
+        for _ in range(count):
+            payee, merchant_categories = random.choice(merchants)
+            item_name = payee[:2] + "".join(random.choice(chars) for _ in range(random.randint(2, 6)))
+            category = random.choice(merchant_categories)
+            # 10% 的账单标注与商家的常见分类不同
+            if random.random() < 0.1:
+                category = random.choice(categories)
+            samples.append((item_name, payee, random.randint(1, 99999) / 100, category))
+        return samples
+
+    merchants = make_merchants(500)
+    train_samples = make_samples(merchants, size)
+    seen_samples = make_samples(merchants, test_size)
+    # 训练数据中没有出现过的商家，应当几乎全部低于阈值交给 GPT
+    unseen_samples = make_samples(make_merchants(500), test_size)
+    model = None
+
+    def train():
+        nonlocal model
+        model = NaiveBayesClassifier().fit(train_samples)
+
+    predictions = None
+
+    def predict():
+        nonlocal predictions
+        predictions = [model.predict(item_name, payee, amount) for item_name, payee, amount, _ in seen_samples]
+
+    train_cost = timeit(train, repeat=1)
+    predict_cost = timeit(predict, repeat=1)
+    print("local classifier train:{} test:{}".format(size, test_size))
+    print("  train   : {:.3f}s".format(train_cost))
+    print("  predict : {:.3f}s ({:.0f} item/s)".format(predict_cost, test_size / predict_cost))
+
+    unseen_predictions = [model.predict(item_name, payee, amount) for item_name, payee, amount, _ in unseen_samples]
+    for name, samples, sample_predictions in (("seen", seen_samples, predictions),
+                                              ("unseen", unseen_samples, unseen_predictions)):
+        for limit in (0.7, 0.8, threshold):
+            confident = [(text, sample[3]) for (text, probability), sample in zip(sample_predictions, samples)
+                         if probability >= limit]
+            correct = sum(1 for text, category in confident if text == category)
+            print("  {:<6} >= {}: {:.1%} of items, accuracy {:.1%}".format(
+                name, limit, len(confident) / len(samples), correct / max(1, len(confident))))
+
+def bench_example_index(size=20000, query_size=5000):
+    """示例索引的构建、增量加入和单次检索耗时"""
+    random.seed(0)
+    chars = [chr(0x4e00 + i) for i in range(300)]
+    categories = [category.value for category in ExpenseCategory if category not in UNTRAINED_CATEGORIES]
+
+    def make_rows(count):
+        rows = []
+        for _ in range(count):
+            payee = "".join(random.choice(chars) for _ in range(random.randint(3, 8)))
+            item_name = payee[:2] + "".join(random.choice(chars) for _ in range(random.randint(2, 10)))
+            rows.append((item_name, payee, 0, random.choice(categories)))
+        return rows
+
+    rows = make_rows(size)
+    new_rows = make_rows(size // 10)
+    queries = [(item_name[:-1], payee) for item_name, payee, _, _ in random.sample(rows, query_size)]
+    index = ExampleIndex()
+    build_cost = timeit(lambda: index.add_samples(rows), repeat=1)
+    add_cost = timeit(lambda: index.add_samples(new_rows), repeat=1)
+    search_cost = timeit(lambda: [index.search(item_name, payee) for item_name, payee in queries], repeat=1)
+    print("example index examples:{} queries:{}".format(len(index), query_size))
+    print("  build      : {:.3f}s".format(build_cost))
+    print("  add {:<6} : {:.3f}s".format(len(new_rows), add_cost))
+    print("  search     : {:.3f}ms/item".format(search_cost * 1000 / query_size))
+
+BENCHMARKS = {
+    "str2timestamp": bench_str2timestamp,
+    "bill_item": bench_bill_item,
+    "substring_matcher": bench_substring_matcher,
+    "local_classifier": bench_local_classifier,
+    "example_index": bench_example_index,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('name', nargs='?', choices=list(BENCHMARKS) + ['all'], default='all')
+    parser.add_argument('--size', type=int, default=None, help='测试数据规模，默认使用各测试自己的规模')
+    args = parser.parse_args()
+
+    for name, bench in BENCHMARKS.items():
+        if args.name in (name, 'all'):
+            if args.size is None:
+                bench()
+            else:
+                bench(args.size)
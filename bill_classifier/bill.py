@@ -3,157 +3,220 @@
 
 import re
 import logging
-import chardet
-import codecs
-import csv
+import sys
+import operator
 
-from util import is_chinese_equal, str2timestamp
+from util import str2timestamp
+from bill_reader import iter_file_rows
 from bill_item import BillType, BillItem
 
 logger = logging.getLogger(__name__)
 
+# 已注册的账单解析器，key 为 config.ini 中的 type
+BILL_CLASSES = {}
+
+def register_bill(bill_class):
+    """注册账单解析器，新增账单格式只需要声明表头列和 parse_row"""
+    BILL_CLASSES[bill_class.type_name] = bill_class
+    return bill_class
+
 class BaseBill:
     file_path: str
     owner: str
     bill_type: str
+    type_name: str = ''
+    file_encoding: str = 'utf-8'
+    # parse_row 需要的字段及其表头名，顺序即 row_mapper 返回的顺序
+    header_columns: tuple = ()
+    # 收/支列的取值，未列出的取值按不计收支处理
+    bill_type_mapping: dict = {}
+    # 解析逻辑变化时加 1，使已缓存的解析结果失效
+    parser_version: int = 2
 
     def __init__(self, bill_file):
         self.file_path = bill_file.file_name
-        self.owner = bill_file.bill_owner
+        self.member = bill_file.member
+        self.password = bill_file.password
+        self.owner = sys.intern(bill_file.bill_owner)
         self.bill_type = 'default'
+        self.row_mapper = None
+
+    @classmethod
+    def match_header(cls, header):
+        header = set(col.strip() for col in header)
+        return all(name in header for _, name in cls.header_columns)
+
+    def compile_row_mapper(self, header):
+        """根据表头计算各字段的列号，返回一次取出所有字段的 itemgetter"""
+        column_index = {col.strip(): i for i, col in enumerate(header)}
+        missing = [name for _, name in self.header_columns if name not in column_index]
+        if missing:
+            raise ValueError("{} 账单表头缺少列: {}".format(self.file_path, ",".join(missing)))
+        return operator.itemgetter(*[column_index[name] for _, name in self.header_columns])
+
+    def iter_bill_rows(self):
+        """逐行读取两条 "------" 分隔线之间的账单行，不在内存中保留整个文件
+
+        分隔线后的第一行是表头，用于编译 row_mapper；之后的数据行不再做表头比较
+        """
+        rows = iter_file_rows(self.file_path, self.file_encoding, self.member, self.password)
+        for row in rows:
+            if row and row[0].lstrip().startswith('------'):
+                break
+
+        for row in rows:
+            if row:
+                self.row_mapper = self.compile_row_mapper(row)
+                break
+
+        for row in rows:
+            if not row:
+                continue
+            # 读到第二个"------"行时结束
+            if row[0].lstrip().startswith('------'):
+                break
+            yield row
+
+    def get_bill_rows(self):
+        return list(self.iter_bill_rows())
 
-    def parse_from_file(self):
-        pass
+    def parse_row(self, row):
+        raise NotImplementedError
 
+    def iter_items(self):
+        """惰性解析账单文件，逐条产出 BillItem"""
+        for row in self.iter_bill_rows():
+            yield self.parse_row(row)
+
+    def parse_from_file(self, bill_item_list):
+        bill_item_list.extend(self.iter_items())
+
+@register_bill
 class AliPayBill(BaseBill):
     bill_time_format: str
+    type_name = 'alipay'
+    # 支付宝账单默认使用 gbk，实际编码由 detect_encoding 检测
+    file_encoding = 'gbk'
+    header_columns = (
+        ('order_id', '商家订单号'),
+        ('create_time', '交易创建时间'),
+        ('pay_time', '付款时间'),
+        ('payee', '交易对方'),
+        ('item_name', '商品名称'),
+        ('amount', '金额（元）'),
+        ('bill_type', '收/支'),
+    )
+    bill_type_mapping = {
+        '收入': BillType.INCOME,
+        '支出': BillType.EXPENSE,
+        '不计收支': BillType.OTHER,
+    }
+
     def __init__(self, bill_file):
         super().__init__(bill_file)
         self.bill_time_format = '%Y-%m-%d %H:%M:%S'
         self.bill_type = 'AliPay'
 
-    def get_bill_rows(self):
-        # 使用chardet检测文件的编码, 微信账单使用 utf
-        file_encoding = 'gbk'
-        bill_rows = []
-        # 使用csv模块读取CSV文件，并自动根据文件编码进行解码
-        with codecs.open(self.file_path, 'r', encoding=file_encoding) as f:
-            reader = csv.reader(f)
-
-            # 初始化标志变量
-            print_flag = False
-
-            # 循环读取每一行并打印指定列
-            for row in reader:
-                row = [col.strip() for col in row]
-                if row[0].startswith('------'):
-                    # 如果读到了第一个"------"行，将标志变量设置为True
-                    if not print_flag:
-                        print_flag = True
-                    # 如果读到了第二个"------"行，将标志变量设置为False，并停止打印
-                    else:
-                        print_flag = False
-                        break
-                else:
-                    # 如果标志变量为True，打印当前行
-                    if print_flag:
-                        if is_chinese_equal(row[0], "交易号"):
-                            continue
-                        bill_rows.append(row)
-
-        return bill_rows
-
-    def parse_from_file(self, bill_item_list):
-        bill_rows = self.get_bill_rows()
-
-        for row in bill_rows:
-            amount = row[9]
-            payee = row[7]
-            item_name = row[8]
-            bill_type_name = row[10]
-            order_id = row[1]
-            if len(row[3]) > 0:
-                bill_time = str2timestamp(row[3], self.bill_time_format)
-            else:
-                bill_time = str2timestamp(row[2], self.bill_time_format)
-            if is_chinese_equal(bill_type_name, '收入'):
-                bill_type = BillType.INCOME
-            elif is_chinese_equal(bill_type_name, '支出'):
-                bill_type = BillType.EXPENSE
-            elif is_chinese_equal(bill_type_name, '不计收支'):
-                bill_type = BillType.OTHER
-
-            bill_item = BillItem(float(amount), payee, item_name, bill_type, order_id, bill_time, "alipay", self.owner)
-
-            bill_item_list.append(bill_item)
-
+    def parse_row(self, row):
+        order_id, create_time, pay_time, payee, item_name, amount, bill_type_name = self.row_mapper(row)
+        # 同一个商家会出现成千上万次，intern 后所有账单共享同一个字符串对象
+        payee = sys.intern(payee.strip())
+        item_name = sys.intern(item_name.strip())
+        pay_time = pay_time.strip()
+        if len(pay_time) > 0:
+            bill_time = str2timestamp(pay_time, self.bill_time_format)
+        else:
+            bill_time = str2timestamp(create_time.strip(), self.bill_time_format)
+        bill_type = self.bill_type_mapping.get(bill_type_name.strip(), BillType.OTHER)
+
+        return BillItem(float(amount), payee, item_name, bill_type, order_id.strip(), bill_time, "alipay", self.owner)
+
+@register_bill
 class WeChatBill(BaseBill):
     bill_time_format: str
+    type_name = 'wechat'
+    # 微信账单默认使用 utf-8，实际编码由 detect_encoding 检测
+    file_encoding = 'utf-8'
+    header_columns = (
+        ('bill_time', '交易时间'),
+        ('payee', '交易对方'),
+        ('item_name', '商品'),
+        ('bill_type', '收/支'),
+        ('amount', '金额(元)'),
+        ('bill_stat', '当前状态'),
+        ('order_id', '交易单号'),
+    )
+    bill_type_mapping = {
+        '收入': BillType.INCOME,
+        '支出': BillType.EXPENSE,
+        '不计支出': BillType.OTHER,
+    }
+
     def __init__(self, bill_file):
         super().__init__(bill_file)
         self.bill_time_format = '%Y-%m-%d %H:%M:%S'
         self.bill_type = 'WeChat'
 
-    def get_bill_rows(self):
-        # 使用chardet检测文件的编码, 微信账单使用 utf
-        file_encoding = 'utf-8'
-        bill_rows = []
-
-        # 使用csv模块读取CSV文件，并自动根据文件编码进行解码
-        with codecs.open(self.file_path, 'r', encoding=file_encoding) as f:
-            reader = csv.reader(f)
-
-            # 初始化标志变量
-            print_flag = False
-
-            # 循环读取每一行并打印指定列
-            for row in reader:
-                row = [col.strip() for col in row]
-                if row[0].startswith('------'):
-                    # 如果读到了第一个"------"行，将标志变量设置为True
-                    if not print_flag:
-                        print_flag = True
-                    # 如果读到了第二个"------"行，将标志变量设置为False，并停止打印
-                    else:
-                        print_flag = False
-                        break
-                else:
-                    # 如果标志变量为True，打印当前行
-                    if print_flag:
-                        if is_chinese_equal(row[0], "交易时间"):
-                            continue
-                        bill_rows.append(row)
-
-        return bill_rows
-
-    def parse_from_file(self, bill_item_list):
-        bill_rows = self.get_bill_rows()
-
-        for row in bill_rows:
-            amount = float(row[5].lstrip(chr(165)))  # 去除 '¥' 符号
-            payee = row[2]
-            item_name = row[3]
-            bill_type_name = row[4]
-            order_id = row[8]
-            bill_stat = row[7]
-            if bill_stat.startswith("已退款"):
-                pattern = r"￥(\d+\.\d+)"
-                match = re.search(pattern, bill_stat)
-                if match:
-                    number = float(match.group(1))
-                    amount = amount - number
-
-            if (len(row[0]) == 19):
-                bill_time = str2timestamp(row[0], "%Y-%m-%d %H:%M:%S")
-            else:
-                bill_time = str2timestamp(row[0], "%Y/%m/%d %H:%M")
-
-            if is_chinese_equal(bill_type_name, '收入'):
-                bill_type = BillType.INCOME
-            elif is_chinese_equal(bill_type_name, '支出'):
-                bill_type = BillType.EXPENSE
-            elif is_chinese_equal(bill_type_name, '不计支出'):
-                bill_type = BillType.OTHER
-
-            bill_item = BillItem(amount, payee, item_name, bill_type, order_id, bill_time, "wechat", self.owner)
-            bill_item_list.append(bill_item)
+    def parse_row(self, row):
+        time_str, payee, item_name, bill_type_name, amount, bill_stat, order_id = self.row_mapper(row)
+        amount = float(amount.strip().lstrip(chr(165)))  # 去除 '¥' 符号
+        payee = sys.intern(payee.strip())
+        item_name = sys.intern(item_name.strip())
+        bill_stat = bill_stat.strip()
+        if bill_stat.startswith("已退款"):
+            pattern = r"￥(\d+\.\d+)"
+            match = re.search(pattern, bill_stat)
+            if match:
+                number = float(match.group(1))
+                amount = amount - number
+
+        time_str = time_str.strip()
+        if (len(time_str) == 19):
+            bill_time = str2timestamp(time_str, "%Y-%m-%d %H:%M:%S")
+        else:
+            bill_time = str2timestamp(time_str, "%Y/%m/%d %H:%M")
+
+        bill_type = self.bill_type_mapping.get(bill_type_name.strip(), BillType.OTHER)
+
+        return BillItem(amount, payee, item_name, bill_type, order_id.strip(), bill_time, "wechat", self.owner)
+
+def sniff_bill_class(bill_file, max_rows=100):
+    """读取文件开头的表头块，返回表头匹配的账单解析器"""
+    rows = iter_file_rows(bill_file.file_name, 'utf-8', bill_file.member, bill_file.password)
+    try:
+        for i, row in enumerate(rows):
+            if i >= max_rows:
+                break
+            for bill_class in BILL_CLASSES.values():
+                if bill_class.match_header(row):
+                    return bill_class
+    finally:
+        rows.close()
+    return None
+
+def create_bill(bill_file):
+    """创建账单解析器：config.ini 中指定了已注册的 type 时直接使用，否则根据表头识别"""
+    bill_class = BILL_CLASSES.get(bill_file.bill_type)
+    if bill_class is None:
+        bill_class = sniff_bill_class(bill_file)
+        if bill_class is None:
+            return None
+        logger.info("{} 识别为 {} 账单".format(bill_file.file_name, bill_class.type_name))
+    return bill_class(bill_file)
+
+bill_time_key = operator.attrgetter('bill_time')
+
+def parse_bill_file(bill_file, bill_cache=None):
+    """解析单个账单文件并返回按时间升序排列的 BillItem 列表，供进程池中的 worker 调用"""
+    bill = create_bill(bill_file)
+    if bill is None:
+        logger.error("未知的账单类型:{} {}".format(bill_file.bill_type, bill_file.file_name))
+        return []
+    if bill_cache is not None:
+        bill_items = list(bill_cache.iter_items(bill))
+    else:
+        bill_items = list(bill.iter_items())
+
+    # 导出文件本身按时间倒序排列，timsort 对整段逆序的数据只需线性时间，且相同时间的账单保持原有顺序
+    bill_items.sort(key=bill_time_key)
+    return bill_items
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import zlib
+import marshal
+import hashlib
+import logging
+from array import array
+
+from bill_item import BillType, BillItem
+
+logger = logging.getLogger(__name__)
+
+# 缓存文件格式变化时需要修改
+CACHE_FORMAT = b'BILLCACHE1'
+
+# 收支类型在缓存中存为 int8 编码
+BILL_TYPE_LIST = list(BillType)
+BILL_TYPE_CODE = {bill_type: code for code, bill_type in enumerate(BILL_TYPE_LIST)}
+
+def file_digest(file_path):
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+class BillCacheWriter:
+    """在账单流式产出的同时按列记录解析结果，记录时立即拷贝字段，不受下游修改 BillItem 的影响"""
+
+    def __init__(self):
+        self.amount = array('d')
+        self.bill_time = array('d')
+        self.bill_type = array('b')
+        self.payee = []
+        self.item_name = []
+        self.order_id = []
+        self.bill_source = []
+        self.owner = []
+
+    def add(self, item: BillItem):
+        self.amount.append(item.amount)
+        self.bill_time.append(item.bill_time)
+        self.bill_type.append(BILL_TYPE_CODE[item.bill_type])
+        self.payee.append(item.payee)
+        self.item_name.append(item.item_name)
+        self.order_id.append(item.order_id)
+        self.bill_source.append(item.bill_source)
+        self.owner.append(item.owner)
+
+    def columns(self):
+        """数值列转为 bytes，字符串列保持列表，可以直接 marshal"""
+        return (
+            self.amount.tobytes(),
+            self.bill_time.tobytes(),
+            self.bill_type.tobytes(),
+            self.payee,
+            self.item_name,
+            self.order_id,
+            self.bill_source,
+            self.owner,
+        )
+
+    def dumps(self):
+        return CACHE_FORMAT + zlib.compress(marshal.dumps(self.columns()), 1)
+
+def dumps_bill_columns(bill_items):
+    """把 BillItem 列表序列化为按列的 marshal 数据，多进程解析时代替 pickle BillItem 对象传回主进程"""
+    writer = BillCacheWriter()
+    for item in bill_items:
+        writer.add(item)
+    return marshal.dumps(writer.columns())
+
+def loads_bill_columns(data):
+    return columns2bill_items(marshal.loads(data))
+
+def loads_bill_items(data):
+    if not data.startswith(CACHE_FORMAT):
+        raise ValueError("unknown bill cache format")
+    return columns2bill_items(marshal.loads(zlib.decompress(data[len(CACHE_FORMAT):])))
+
+def columns2bill_items(columns):
+    amount_bytes, time_bytes, type_bytes, payee_list, item_name_list, order_id_list, source_list, owner_list = columns
+    amount_list = array('d')
+    amount_list.frombytes(amount_bytes)
+    time_list = array('d')
+    time_list.frombytes(time_bytes)
+    type_list = array('b')
+    type_list.frombytes(type_bytes)
+
+    bill_items = []
+    for i in range(len(time_list)):
+        bill_items.append(BillItem(amount_list[i], sys.intern(payee_list[i]), sys.intern(item_name_list[i]),
+                                   BILL_TYPE_LIST[type_list[i]], order_id_list[i], time_list[i],
+                                   source_list[i], sys.intern(owner_list[i])))
+    return bill_items
+
+class BillCache:
+    """解析结果的磁盘缓存
+
+    key 由账单文件内容的 sha256、解析器类型与版本、账单人组成，文件内容或解析器变化后自动失效；
+    缓存目录超过 max_size 字节时按最近访问时间淘汰
+    """
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def cache_key(self, bill):
+        key = "{}:{}:{}:{}:{}".format(file_digest(bill.file_path), bill.member, type(bill).__name__,
+                                      bill.parser_version, bill.owner)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def _cache_path(self, key):
+        return os.path.join(self.cache_dir, key + '.bin')
+
+    def get(self, key):
+        cache_path = self._cache_path(key)
+        try:
+            with open(cache_path, 'rb') as f:
+                data = f.read()
+            bill_items = loads_bill_items(data)
+        except FileNotFoundError:
+            return None
+        except (ValueError, EOFError, TypeError, zlib.error) as err:
+            logger.warning("账单缓存损坏 {}: {}".format(cache_path, err))
+            return None
+
+        # mtime 作为最近访问时间，用于 LRU 淘汰
+        os.utime(cache_path)
+        return bill_items
+
+    def put(self, key, data):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cache_path = self._cache_path(key)
+        tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, cache_path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.bin'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total_size += stat.st_size
+
+        entries.sort()
+        for _, size, name in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            logger.info("淘汰账单缓存: {}".format(name))
+
+    def iter_items(self, bill):
+        """优先从缓存读取账单，未命中时边解析边产出，解析完成后写入缓存"""
+        key = self.cache_key(bill)
+        bill_items = self.get(key)
+        if bill_items is not None:
+            logger.info("账单缓存命中: {}".format(bill.file_path))
+            yield from bill_items
+            return
+
+        writer = BillCacheWriter()
+        for item in bill.iter_items():
+            writer.add(item)
+            yield item
+        self.put(key, writer.dumps())
+
+def create_bill_cache(parse_config):
+    if not parse_config.cache_dir:
+        return None
+    return BillCache(parse_config.cache_dir, parse_config.cache_size_mb * 1024 * 1024)
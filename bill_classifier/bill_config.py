@@ -12,6 +12,10 @@ class FeishuConfig:
     user_name: str
     bill_sheet_token: str
     category_sheet_token: str
+    timeout: float
+    max_retries: int
+    upload_chunk_rows: int
+    upload_workers: int
 
     def __init__(self):
         pass
@@ -19,6 +23,38 @@ class FeishuConfig:
 class GPTConfig:
     api_key: str
     call_limit: int
+    batch_size: int
+    base_url: str
+    concurrency: int
+    requests_per_minute: int
+    tokens_per_minute: int
+    timeout: float
+    token_budget: int
+    example_index_file: str
+    example_count: int
+    cache_file: str
+    cache_ttl_days: int
+    cache_max_entries: int
+
+    def __init__(self):
+        pass
+
+
+class ParseConfig:
+    workers: int
+    cache_dir: str
+    cache_size_mb: int
+
+    def __init__(self):
+        pass
+
+
+class StrategyConfig:
+    rule_file: str
+    local_model_file: str
+    local_model_threshold: float
+    category_snapshot_file: str
+    category_index_file: str
 
     def __init__(self):
         pass
@@ -27,6 +63,8 @@ class GPTConfig:
 class BillConfig:
     feishu_config: FeishuConfig
     gpt_config: GPTConfig
+    parse_config: ParseConfig
+    strategy_config: StrategyConfig
 
     def __init__(self, config):
         self.feishu_config = FeishuConfig()
@@ -41,7 +79,49 @@ class BillConfig:
         self.feishu_config.user_name = config.get('feishu', 'user_name', fallback='')
         self.feishu_config.bill_sheet_token = config.get('feishu', 'bill_sheet_token', fallback='')
         self.feishu_config.category_sheet_token = config.get('feishu', 'category_sheet_token', fallback='')
+        # 飞书接口的超时秒数，限流或服务端错误时的最大重试次数
+        self.feishu_config.timeout = config.getfloat('feishu', 'timeout', fallback=10)
+        self.feishu_config.max_retries = config.getint('feishu', 'max_retries', fallback=3)
+        # 写入账单明细时每次请求的行数（不超过 2000）和并发上传的请求数
+        self.feishu_config.upload_chunk_rows = config.getint('feishu', 'upload_chunk_rows', fallback=2000)
+        self.feishu_config.upload_workers = config.getint('feishu', 'upload_workers', fallback=4)
 
         self.gpt_config = GPTConfig()
         self.gpt_config.api_key = config.get('gpt', 'api_key')
         self.gpt_config.call_limit = int(config.get('gpt', 'call_limit'))
+        # 每次请求打包分类的账单条数，1 表示逐条请求
+        self.gpt_config.batch_size = config.getint('gpt', 'batch_size', fallback=20)
+        # OpenAI 兼容服务的地址，为空时使用官方地址
+        self.gpt_config.base_url = config.get('gpt', 'base_url', fallback='')
+        # 同时进行的请求数；每分钟的请求数、token 数上限，0 表示不限制；单次请求超时秒数
+        self.gpt_config.concurrency = config.getint('gpt', 'concurrency', fallback=4)
+        self.gpt_config.requests_per_minute = config.getint('gpt', 'requests_per_minute', fallback=0)
+        self.gpt_config.tokens_per_minute = config.getint('gpt', 'tokens_per_minute', fallback=0)
+        self.gpt_config.timeout = config.getfloat('gpt', 'timeout', fallback=60)
+        # 每次运行按提示词长度预估的 token 预算，<=0 表示不限制；预算按账单金额从高到低分配
+        self.gpt_config.token_budget = config.getint('gpt', 'token_budget', fallback=0)
+        # 历史账单示例索引文件，为空或文件不存在时提示词中不带示例；每条账单检索的示例条数
+        self.gpt_config.example_index_file = config.get('gpt', 'example_index_file', fallback='')
+        self.gpt_config.example_count = config.getint('gpt', 'example_count', fallback=3)
+        # GPT 分类结果的缓存文件，为空时不缓存；缓存条目的有效天数（<=0 表示不过期）和最大条数
+        self.gpt_config.cache_file = config.get('gpt', 'cache_file', fallback='')
+        self.gpt_config.cache_ttl_days = config.getint('gpt', 'cache_ttl_days', fallback=180)
+        self.gpt_config.cache_max_entries = config.getint('gpt', 'cache_max_entries', fallback=20000)
+
+        self.parse_config = ParseConfig()
+        # 1: 在主进程中逐个解析; >1: 进程池并发解析; <=0: 使用全部 CPU 核数
+        self.parse_config.workers = config.getint('parse', 'workers', fallback=1)
+        # 为空时不缓存解析结果
+        self.parse_config.cache_dir = config.get('parse', 'cache_dir', fallback='')
+        self.parse_config.cache_size_mb = config.getint('parse', 'cache_size_mb', fallback=64)
+
+        self.strategy_config = StrategyConfig()
+        # 跳过、合并、排除 GPT 等规则文件，为空时不使用规则
+        self.strategy_config.rule_file = config.get('strategy', 'rule_file', fallback='config/rules.json')
+        # 本地分类模型文件，为空或文件不存在时跳过；后验概率不低于阈值的结果才采用，其余交给 GPT
+        self.strategy_config.local_model_file = config.get('strategy', 'local_model_file', fallback='')
+        self.strategy_config.local_model_threshold = config.getfloat('strategy', 'local_model_threshold', fallback=0.9)
+        # 分类字典的本地快照，为空时每次都从飞书下载且飞书不可用时无法分类
+        self.strategy_config.category_snapshot_file = config.get('strategy', 'category_snapshot_file', fallback='')
+        # 分类字典编译后的索引文件，表格版本号未变化时直接加载，为空时每次重新编译
+        self.strategy_config.category_index_file = config.get('strategy', 'category_index_file', fallback='')
@@ -2,9 +2,13 @@ class BillFile:
     file_name: str
     bill_owner: str
     bill_type: str
+    member: str
+    password: str
 
-    def __init__(self, file_name, bill_owner, bill_type):
+    def __init__(self, file_name, bill_owner, bill_type, member='', password=''):
         self.file_name = file_name
         self.bill_owner = bill_owner
         self.bill_type = bill_type
+        self.member = member        # zip 压缩包中的账单文件名，为空时取第一个 csv/xlsx
+        self.password = password    # zip 压缩包的解压密码
 
@@ -17,7 +17,10 @@ class ClassifyAlg(Enum):
     MATCH = "完全匹配"
     REGULAR = "模糊匹配"
     WET_MARKET = "菜场模式"
+    LOCAL = "本地模型"
     GPT = "GPT模式"
+    # 明细页中人工复核过的账单，在分类算法列选择这一项后才会作为本地模型的训练数据
+    MANUAL = "人工标注"
     UNKNOWN = "无法识别"
 
     def to_str(self) -> str:
@@ -26,6 +29,10 @@ class ClassifyAlg(Enum):
 class BillItem:
     amount: float
     bill_time: float
+    # 大账单会有几十万个 BillItem，使用 __slots__ 去掉每个对象的 __dict__
+    __slots__ = ('amount', 'payee', 'item_name', 'bill_type', 'order_id', 'bill_time',
+                 'bill_source', 'owner', 'category', 'classify_alg')
+
     def __init__(self, amount, payee, item_name, bill_type, order_id, bill_time, bill_source="unknown", owner=""):
         self.amount = amount            # 金额
         self.payee = payee              # 交易对象
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import csv
+import codecs
+import logging
+import datetime
+import functools
+import zipfile
+
+import chardet
+
+logger = logging.getLogger(__name__)
+
+# 编码检测只读取文件开头的这部分字节
+ENCODING_SAMPLE_SIZE = 64 * 1024
+
+# 可以直接读取的账单文件类型
+BILL_FILE_SUFFIXES = ('.csv', '.xlsx')
+
+def _can_decode(sample, encoding):
+    try:
+        # final=False: 样本末尾被截断的多字节字符不算解码失败
+        codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+    except (UnicodeDecodeError, LookupError):
+        return False
+    return True
+
+def detect_sample_encoding(sample, default_encoding, source_name=''):
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if sample.isascii():
+        return default_encoding
+    # utf-8 的校验很严格，非 utf-8 的中文文本几乎不可能通过
+    if _can_decode(sample, 'utf-8'):
+        return 'utf-8'
+    if _can_decode(sample, default_encoding):
+        return default_encoding
+
+    result = chardet.detect(sample)
+    encoding = result.get('encoding')
+    if encoding and _can_decode(sample, encoding):
+        return encoding
+
+    logger.warning("无法识别文件编码: {}, 使用默认编码 {}".format(source_name, default_encoding))
+    return default_encoding
+
+def _file_suffix(file_name):
+    return os.path.splitext(file_name)[1].lower()
+
+def _open_zip(file_path, password):
+    zip_file = zipfile.ZipFile(file_path)
+    if password:
+        zip_file.setpassword(password.encode('utf-8'))
+    return zip_file
+
+def find_zip_member(zip_file, member=''):
+    """返回压缩包中的账单文件名：指定了 member 时直接使用，否则取第一个 csv/xlsx 文件"""
+    if member:
+        return member
+    for info in zip_file.infolist():
+        if info.is_dir() or info.filename.startswith('__MACOSX/'):
+            continue
+        if _file_suffix(info.filename) in BILL_FILE_SUFFIXES:
+            return info.filename
+    raise ValueError("{} 中没有找到 csv/xlsx 账单文件".format(zip_file.filename))
+
+@functools.lru_cache(maxsize=128)
+def _detect_encoding(file_path, member, password, file_size, file_mtime, default_encoding):
+    if _file_suffix(file_path) == '.zip':
+        with _open_zip(file_path, password) as zip_file:
+            with zip_file.open(find_zip_member(zip_file, member)) as f:
+                sample = f.read(ENCODING_SAMPLE_SIZE)
+    else:
+        with open(file_path, 'rb') as f:
+            sample = f.read(ENCODING_SAMPLE_SIZE)
+    return detect_sample_encoding(sample, default_encoding, file_path)
+
+def detect_encoding(file_path, default_encoding, member='', password=''):
+    """根据文件开头的样本识别文件编码，同一个文件（路径、大小、修改时间均不变）只检测一次"""
+    stat = os.stat(file_path)
+    return _detect_encoding(file_path, member, password, stat.st_size, stat.st_mtime_ns, default_encoding)
+
+def _cell2str(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime.datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return str(value)
+
+def iter_xlsx_rows(xlsx_file):
+    """以只读模式流式读取第一个工作表，单元格统一转换为与 csv 一致的字符串"""
+    try:
+        import openpyxl
+    except ImportError:
+        raise ImportError("读取 xlsx 账单需要安装 openpyxl: pip install openpyxl")
+
+    workbook = openpyxl.load_workbook(xlsx_file, read_only=True, data_only=True)
+    try:
+        for row in workbook.worksheets[0].iter_rows(values_only=True):
+            yield [_cell2str(value) for value in row]
+    finally:
+        workbook.close()
+
+def iter_csv_rows(f, file_encoding):
+    text = io.TextIOWrapper(f, encoding=file_encoding, newline='')
+    yield from csv.reader(text)
+
+def iter_file_rows(file_path, default_encoding, member='', password=''):
+    """逐行读取账单文件，支持 csv、xlsx 以及包含它们的 zip 压缩包，不解压到临时文件"""
+    suffix = _file_suffix(file_path)
+    if suffix == '.zip':
+        with _open_zip(file_path, password) as zip_file:
+            member = find_zip_member(zip_file, member)
+            if _file_suffix(member) == '.xlsx':
+                # openpyxl 需要可随机访问的文件，这里只读入压缩后的 xlsx 字节，工作表内容仍按行流式读取
+                yield from iter_xlsx_rows(io.BytesIO(zip_file.read(member)))
+            else:
+                file_encoding = detect_encoding(file_path, default_encoding, member, password)
+                with zip_file.open(member) as f:
+                    yield from iter_csv_rows(f, file_encoding)
+    elif suffix == '.xlsx':
+        yield from iter_xlsx_rows(file_path)
+    else:
+        file_encoding = detect_encoding(file_path, default_encoding)
+        with open(file_path, 'rb') as f:
+            yield from iter_csv_rows(f, file_encoding)
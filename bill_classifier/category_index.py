@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import marshal
+import logging
+
+from bill_item import ClassifyAlg
+from category import expense_category_mapping
+from matcher import SubstringMatcher
+from category_snapshot import fetch_revision, load_category_maps
+
+logger = logging.getLogger(__name__)
+
+# 索引文件格式变化时需要修改
+INDEX_FORMAT = 1
+
+class CategoryIndex:
+    """分类字典编译后的查询结构：完全匹配字典和模糊匹配自动机
+
+    分类以字符串保存，命中时才转换为 ExpenseCategory，加载索引文件只需一次 marshal.loads，
+    不需要按规则条数做任何处理
+    """
+
+    def __init__(self, revision, item_dict, payee_dict, item_matcher, payee_matcher):
+        self.revision = revision
+        self.item_dict = item_dict          # item_name -> 分类字符串
+        self.payee_dict = payee_dict        # payee -> 分类字符串
+        self.item_matcher = item_matcher    # SubstringMatcher，值为分类字符串
+        self.payee_matcher = payee_matcher
+
+    @classmethod
+    def build(cls, revision, payee_map, item_map, payee_regular_map, item_regular_map):
+        """由 {key: ExpenseCategory} 字典编译索引"""
+        def to_str(value_map):
+            return {key: category.value for key, category in value_map.items()}
+        return cls(revision, to_str(item_map), to_str(payee_map),
+                   SubstringMatcher(to_str(item_regular_map)), SubstringMatcher(to_str(payee_regular_map)))
+
+    def classify(self, item_name, payee):
+        """依次按 item_name、payee 完全匹配，item_name、payee 模糊匹配，返回 (ExpenseCategory, ClassifyAlg)
+
+        没有命中时返回 (None, None)
+        """
+        category = self.item_dict.get(item_name)
+        if category is None:
+            category = self.payee_dict.get(payee)
+        if category is not None:
+            return expense_category_mapping[category], ClassifyAlg.MATCH
+
+        # 模糊匹配（子串匹配），命中字典中第一个出现在文本中的子串
+        category = self.item_matcher.match(item_name)
+        if category is None:
+            category = self.payee_matcher.match(payee)
+        if category is not None:
+            return expense_category_mapping[category], ClassifyAlg.REGULAR
+        return None, None
+
+    def dumps(self, sheet_token, value_ranges):
+        return marshal.dumps((INDEX_FORMAT, sheet_token, list(value_ranges), self.revision,
+                              self.item_dict, self.payee_dict,
+                              self.item_matcher.to_state(), self.payee_matcher.to_state()))
+
+    @classmethod
+    def loads(cls, data, sheet_token, value_ranges):
+        """格式、表格或区域不一致时返回 None"""
+        index_format, index_sheet_token, index_ranges, revision, item_dict, payee_dict, item_state, payee_state = \
+            marshal.loads(data)
+        if index_format != INDEX_FORMAT or index_sheet_token != sheet_token or index_ranges != list(value_ranges):
+            return None
+        return cls(revision, item_dict, payee_dict,
+                   SubstringMatcher.from_state(item_state), SubstringMatcher.from_state(payee_state))
+
+def load_index_file(index_file, sheet_token, value_ranges):
+    if not index_file:
+        return None
+    try:
+        with open(index_file, 'rb') as f:
+            data = f.read()
+        return CategoryIndex.loads(data, sheet_token, value_ranges)
+    except FileNotFoundError:
+        return None
+    except (ValueError, EOFError, TypeError) as err:
+        logger.warning("分类索引损坏 {}: {}".format(index_file, err))
+        return None
+
+def save_index_file(index_file, category_index, sheet_token, value_ranges):
+    index_dir = os.path.dirname(index_file)
+    if index_dir:
+        os.makedirs(index_dir, exist_ok=True)
+    tmp_file = "{}.{}.tmp".format(index_file, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        f.write(category_index.dumps(sheet_token, value_ranges))
+    os.replace(tmp_file, index_file)
+
+def load_category_index(feishu_api, value_ranges, snapshot_file='', index_file=''):
+    """返回 (ret, CategoryIndex)
+
+    value_ranges 依次是完全匹配 payee、item_name，模糊匹配 payee、item_name 的字典区域；
+    表格版本号与索引文件一致时直接加载索引文件，否则读取分类字典重新编译并保存；
+    版本号查询失败时也先尝试读取分类字典，读取失败才使用索引文件（可能不是最新的）
+    """
+    revision = fetch_revision(feishu_api)
+    category_index = load_index_file(index_file, feishu_api.sheet_token, value_ranges)
+    if category_index is not None and revision is not None and revision == category_index.revision:
+        logger.info("使用编译好的分类索引 revision:{}".format(category_index.revision))
+        return True, category_index
+
+    ret, value_maps, revision = load_category_maps(feishu_api, value_ranges, snapshot_file, revision)
+    if not ret:
+        if category_index is None:
+            return False, None
+        logger.warning("飞书不可用，使用本地分类索引 revision:{}".format(category_index.revision))
+        return True, category_index
+
+    # 飞书不可用时 load_category_maps 返回本地快照，与索引文件版本一致时不需要重新编译
+    if category_index is not None and revision is not None and revision == category_index.revision:
+        logger.info("使用编译好的分类索引 revision:{}".format(category_index.revision))
+        return True, category_index
+
+    category_index = CategoryIndex.build(revision, *value_maps)
+    if index_file and revision is not None:
+        save_index_file(index_file, category_index, feishu_api.sheet_token, value_ranges)
+        logger.info("更新分类索引 revision:{}".format(revision))
+    return True, category_index
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import logging
+
+import requests
+
+from category import expense_category_mapping
+
+logger = logging.getLogger(__name__)
+
+def load_category_snapshot(snapshot_file, sheet_token, value_ranges):
+    """返回 (表格版本号, 字典列表)，快照不存在或与当前表格、区域不一致时返回 (None, None)"""
+    if not snapshot_file:
+        return None, None
+    try:
+        with open(snapshot_file, 'r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return None, None
+    except ValueError as err:
+        logger.warning("分类字典快照损坏 {}: {}".format(snapshot_file, err))
+        return None, None
+
+    if snapshot.get('sheet_token') != sheet_token or snapshot.get('ranges') != list(value_ranges):
+        return None, None
+    value_maps = [{key: expense_category_mapping[category] for key, category in value_map.items()}
+                  for value_map in snapshot['value_maps']]
+    return snapshot['revision'], value_maps
+
+def save_category_snapshot(snapshot_file, sheet_token, value_ranges, revision, value_maps):
+    snapshot_dir = os.path.dirname(snapshot_file)
+    if snapshot_dir:
+        os.makedirs(snapshot_dir, exist_ok=True)
+    tmp_file = "{}.{}.tmp".format(snapshot_file, os.getpid())
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump({
+            'sheet_token': sheet_token,
+            'ranges': list(value_ranges),
+            'revision': revision,
+            'value_maps': [{key: category.value for key, category in value_map.items()} for value_map in value_maps],
+        }, f, ensure_ascii=False)
+    os.replace(tmp_file, snapshot_file)
+
+def fetch_revision(feishu_api):
+    """查询分类表格的版本号，飞书不可用时返回 None"""
+    try:
+        ret, revision = feishu_api.GetSpreadsheetRevision()
+    except (requests.RequestException, ValueError, KeyError) as err:
+        logger.warning("查询飞书表格版本失败: {}".format(err))
+        return None
+    return revision if ret else None
+
+def load_category_maps(feishu_api, value_ranges, snapshot_file='', revision=None):
+    """读取分类字典，返回 (ret, 与 value_ranges 顺序一致的字典列表, 字典对应的表格版本号)
+
+    revision 是 fetch_revision() 查到的当前版本号，与本地快照一致时直接使用快照，否则下载并更新快照；
+    版本号查询失败（revision 为 None）时同样尝试下载，下载也失败时才退回到本地快照（可能不是最新的）
+    """
+    snapshot_revision, snapshot_maps = load_category_snapshot(snapshot_file, feishu_api.sheet_token, value_ranges)
+    if revision is not None and snapshot_maps is not None and revision == snapshot_revision:
+        logger.info("分类字典未变化，使用本地快照 revision:{}".format(revision))
+        return True, snapshot_maps, revision
+
+    try:
+        ret, value_maps = feishu_api.GetCategoryClassificationInfoBatch(value_ranges)
+    except (requests.RequestException, ValueError, KeyError) as err:
+        logger.warning("读取飞书分类字典失败: {}".format(err))
+        ret = False
+
+    if not ret:
+        if snapshot_maps is None:
+            return False, [], None
+        logger.warning("飞书不可用，使用本地分类字典快照 revision:{}".format(snapshot_revision))
+        return True, snapshot_maps, snapshot_revision
+
+    if snapshot_file:
+        # 版本号未知时也保存快照，供飞书不可用时使用；下次查到版本号后会重新下载
+        save_category_snapshot(snapshot_file, feishu_api.sheet_token, value_ranges, revision, value_maps)
+        logger.info("更新分类字典快照 revision:{}".format(revision))
+    return True, value_maps, revision
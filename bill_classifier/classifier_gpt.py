@@ -1,8 +1,54 @@
 import os
-from openai import OpenAI
+import time
+import hashlib
+import asyncio
+from openai import OpenAI, AsyncOpenAI, OpenAIError
 import logging
 import json
 
+class RateLimiter:
+    """按最近 60 秒的滑动窗口限制请求数和 token 数，0 表示不限制
+
+    acquire() 时按估算的 token 数占用额度，请求返回后 record() 修正为实际用量
+    """
+
+    WINDOW = 60
+
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        # [发起时间, token 数]
+        self.records = []
+        self.lock = asyncio.Lock()
+
+    def _wait_time(self, tokens, now):
+        while self.records and now - self.records[0][0] >= self.WINDOW:
+            self.records.pop(0)
+        if not self.records:
+            return 0
+        if self.requests_per_minute > 0 and len(self.records) >= self.requests_per_minute:
+            return self.records[0][0] + self.WINDOW - now
+        if self.tokens_per_minute > 0:
+            used = sum(record[1] for record in self.records)
+            # 单个请求超过额度时只能等窗口清空后单独发出
+            if used + tokens > self.tokens_per_minute:
+                return self.records[0][0] + self.WINDOW - now
+        return 0
+
+    async def acquire(self, tokens):
+        async with self.lock:
+            while True:
+                wait = self._wait_time(tokens, time.monotonic())
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            reservation = [time.monotonic(), tokens]
+            self.records.append(reservation)
+            return reservation
+
+    def record(self, reservation, tokens):
+        reservation[1] = tokens
+
 class GPTClassifier:
     # 系统提示词：定义角色、任务和输出格式
     system_template = """
@@ -24,6 +70,26 @@ class GPTClassifier:
     3. 考虑账单的完整上下文
     """
 
+    # 批量分类的系统提示词：与 system_template 相同，但输出要求改为按编号返回结果数组
+    batch_system_template = """
+    角色：你是一位在北京生活多年的家庭主妇，对日常消费和账单分类有丰富的经验。
+
+    任务：对多条账单分别进行分类，需要你：
+    1. 仔细分析每条账单的所有信息（名称、支付方、金额、时间等）
+    2. 结合你的生活经验，判断最合适的分类
+    3. 如果信息不足或无法确定，该条账单返回 'unknown'
+
+    输出要求：
+    1. 使用 JSON 格式返回结果
+    2. 只返回 results 字段，results 是数组，每个元素包含 id 和 category 两个字段
+    3. id 是账单的编号，category 的值必须是以下类别之一：{}
+
+    注意事项：
+    1. 保持客观，不要过度推理
+    2. 如果信息模糊，宁可返回 'unknown' 也不要随意猜测
+    3. 每条账单单独判断，不要受同一批次中其他账单的影响
+    """
+
     # 用户提示词：提供具体的账单信息
     user_template = """
     请对以下账单进行分类：
@@ -37,6 +103,22 @@ class GPTClassifier:
     请根据以上信息，给出最合适的分类。
     """
 
+    # 批量分类的用户提示词：每条账单带有批次内的编号，结果按编号返回
+    batch_user_template = """
+    请对以下 {count} 条账单分别进行分类，每行是一条账单，格式为 编号|名称|支付方|金额(元)|时间：
+
+{bills}
+
+    输出格式：{{"results": [{{"id": 编号, "category": 分类}}, ...]}}，每个编号都必须返回且只返回一次。
+    """
+
+    # 检索到的相似历史账单，作为 few-shot 示例附在用户提示词后面
+    example_template = """
+    参考以下已标注的相似历史账单，格式为 名称|支付方|分类：
+
+{examples}
+    """
+
     class_list = "'餐饮','日常开支','服装鞋帽','护肤品','水电物业','医疗','育儿','交通'"
     class_index = {
         "dining": "餐饮",
@@ -47,42 +129,261 @@ class GPTClassifier:
         "medical": "医疗",
         "unknown": "unknown"
     }
+    model = "gpt-4-turbo-2024-04-09"
+    # 预估花费时每条账单输出结果的 token 数
+    output_tokens_per_bill = 20
     token_count = 0
     client = None
 
 
-    def __init__(self, api_key, class_list = ""):
+    def __init__(self, api_key, class_list = "", base_url = None, cache = None, example_index = None, example_count = 3):
         if len(class_list) > 0:
             self.class_list = class_list
         self.token_count = 0
-        self.client = OpenAI(api_key=api_key)
+        # base_url 可以指向任意 OpenAI 兼容的服务，例如本地的测试桩
+        self.base_url = base_url or None
+        self.api_key = api_key
+        self.client = OpenAI(api_key=api_key, base_url=self.base_url)
+        # ClassifyCache，为 None 时不缓存分类结果
+        self.cache = cache
+        # ExampleIndex，为 None 时提示词中不带示例
+        self.example_index = example_index
+        self.example_count = example_count
+        # 示例只取 class_list 中的分类，避免示例与系统提示词限定的分类矛盾
+        self.example_categories = frozenset(name.strip().strip("'\"") for name in self.class_list.split(','))
+        self.prompt_version = hashlib.sha256("\0".join([
+            self.system_template, self.batch_system_template, self.user_template, self.batch_user_template,
+            self.example_template, self.class_list
+        ]).encode('utf-8')).hexdigest()[:16]
 
-    def call(self, item_name, payee, amount, timestamp):
-        system_content = self.system_template.format(self.class_list)
-        user_content = self.user_template.format(
-            item_name=item_name,
-            payee=payee,
-            amount=amount,
-            timestamp=timestamp
-        )
+    def _system_content(self, batch):
+        template = self.batch_system_template if batch else self.system_template
+        return template.format(self.class_list)
 
+    def _create(self, user_content, batch=False):
+        system_content = self._system_content(batch)
         response = self.client.chat.completions.create(
             # model="gpt-3.5-turbo-0125",
-            model="gpt-4-turbo-2024-04-09",
+            model=self.model,
             response_format={ "type": "json_object" },
             messages = [
                 {"role": "system", "content": system_content},
                 {"role": "user", "content": user_content}
             ]
         )
-        
+
         self.token_count += response.usage.total_tokens
-        content = json.loads(response.choices[0].message.content)
+        return response.choices[0].message.content
+
+    def _format_examples(self, bills):
+        """检索每条账单最相似的历史账单，去重后拼成示例段落"""
+        if self.example_index is None or self.example_count <= 0:
+            return ''
+        examples = {}
+        for item_name, payee, _, _ in bills:
+            for example in self.example_index.search(item_name, payee, self.example_count, self.example_categories):
+                examples[example] = True
+        if not examples:
+            return ''
+        lines = ["    {}|{}|{}".format(*(str(value).replace('|', ' ').replace('\n', ' ') for value in example))
+                 for example in examples]
+        return self.example_template.format(examples="\n".join(lines))
+
+    def _format_single(self, item_name, payee, amount, timestamp):
+        return self.user_template.format(
+            item_name=item_name,
+            payee=payee,
+            amount=amount,
+            timestamp=timestamp
+        ) + self._format_examples([(item_name, payee, amount, timestamp)])
+
+    def estimate_tokens(self, bills):
+        """按字符数预估一次请求 bills 的 token 花费，中文一个字大约一个 token，宁可高估"""
+        if len(bills) == 0:
+            return 0
+        if len(bills) == 1:
+            user_content = self._format_single(*bills[0])
+        else:
+            user_content = self._format_batch(bills)
+        system_content = self._system_content(len(bills) > 1)
+        return len(system_content) + len(user_content) + self.output_tokens_per_bill * len(bills)
+
+    def is_cached(self, item_name, payee):
+        if self.cache is None:
+            return False
+        return self.cache.peek(self.model, self.prompt_version, item_name, payee) is not None
+
+    def _call_single(self, item_name, payee, amount, timestamp):
+        content = json.loads(self._create(self._format_single(item_name, payee, amount, timestamp)))
         return content["category"]
 
+    def _lookup_cache(self, bills):
+        """返回 (与 bills 对应的缓存结果，未命中为 None, 未命中的下标列表)"""
+        if self.cache is None:
+            return [None] * len(bills), list(range(len(bills)))
+        categories = [self.cache.get(self.model, self.prompt_version, item_name, payee)
+                      for item_name, payee, _, _ in bills]
+        return categories, [i for i, category in enumerate(categories) if category is None]
+
+    def _update_cache(self, bills, categories):
+        if self.cache is None:
+            return
+        for (item_name, payee, _, _), category in zip(bills, categories):
+            # 超时或失败的空结果不缓存
+            if category:
+                self.cache.put(self.model, self.prompt_version, item_name, payee, category)
+
+    def call(self, item_name, payee, amount, timestamp):
+        return self.call_batch([(item_name, payee, amount, timestamp)])[0]
+
+    def _format_batch(self, bills):
+        lines = []
+        for index, (item_name, payee, amount, timestamp) in enumerate(bills):
+            # 分隔符和换行会破坏行格式，替换为空格
+            item_name = str(item_name).replace('|', ' ').replace('\n', ' ')
+            payee = str(payee).replace('|', ' ').replace('\n', ' ')
+            lines.append("    {}|{}|{}|{}|{}".format(index, item_name, payee, amount, timestamp))
+        return self.batch_user_template.format(count=len(bills), bills="\n".join(lines)) + self._format_examples(bills)
+
+    def _parse_batch(self, content, count):
+        """解析批量结果，编号缺失、重复或格式错误时返回 None"""
+        try:
+            results = json.loads(content)["results"]
+            categories = [None] * count
+            for result in results:
+                index = int(result["id"])
+                if index < 0 or index >= count or categories[index] is not None:
+                    return None
+                categories[index] = str(result["category"])
+        except (ValueError, KeyError, TypeError):
+            return None
+        if None in categories:
+            return None
+        return categories
+
+    def call_batch(self, bills):
+        """一次请求对多条账单分类，bills 为 (item_name, payee, amount, timestamp) 列表
+
+        返回与 bills 一一对应的分类列表；结果格式错误时拆成两半分别重试，单条账单退化为 call()
+        """
+        categories, miss_indexes = self._lookup_cache(bills)
+        miss_bills = [bills[i] for i in miss_indexes]
+        for i, category in zip(miss_indexes, self._call_batch(miss_bills)):
+            categories[i] = category
+        self._update_cache(miss_bills, [categories[i] for i in miss_indexes])
+        return categories
+
+    def _call_batch(self, bills):
+        if len(bills) == 0:
+            return []
+        if len(bills) == 1:
+            return [self._call_single(*bills[0])]
+
+        categories = self._parse_batch(self._create(self._format_batch(bills), batch=True), len(bills))
+        if categories is not None:
+            return categories
+
+        logging.warning("gpt 批量分类结果格式错误，拆分重试 batch size:{}".format(len(bills)))
+        half = len(bills) // 2
+        return self._call_batch(bills[:half]) + self._call_batch(bills[half:])
+
+    async def _create_async(self, client, user_content, limiter, timeout, batch=False):
+        system_content = self._system_content(batch)
+        # 按字符数估算 token，中文一个字大约一个 token，宁可高估
+        reservation = await limiter.acquire(len(system_content) + len(user_content))
+        response = await asyncio.wait_for(client.chat.completions.create(
+            model=self.model,
+            response_format={ "type": "json_object" },
+            messages = [
+                {"role": "system", "content": system_content},
+                {"role": "user", "content": user_content}
+            ]
+        ), timeout)
+
+        limiter.record(reservation, response.usage.total_tokens)
+        self.token_count += response.usage.total_tokens
+        return response.choices[0].message.content
+
+    async def _call_batch_async(self, client, bills, limiter, timeout):
+        if len(bills) == 0:
+            return []
+        try:
+            if len(bills) == 1:
+                content = json.loads(await self._create_async(client, self._format_single(*bills[0]), limiter, timeout))
+                return [str(content["category"])]
+
+            content = await self._create_async(client, self._format_batch(bills), limiter, timeout, batch=True)
+        except asyncio.TimeoutError:
+            logging.warning("gpt 分类请求超时 batch size:{}".format(len(bills)))
+            return [''] * len(bills)
+        except OpenAIError as err:
+            # 接口错误、连接失败、限流等只影响当前批次，其他批次的结果照常返回并写入缓存
+            logging.warning("gpt 分类请求失败 batch size:{}: {}".format(len(bills), err))
+            return [''] * len(bills)
+        except (ValueError, KeyError, TypeError) as err:
+            logging.warning("gpt 分类结果格式错误: {}".format(err))
+            return [''] * len(bills)
+
+        categories = self._parse_batch(content, len(bills))
+        if categories is not None:
+            return categories
+
+        logging.warning("gpt 批量分类结果格式错误，拆分重试 batch size:{}".format(len(bills)))
+        half = len(bills) // 2
+        return (await self._call_batch_async(client, bills[:half], limiter, timeout) +
+                await self._call_batch_async(client, bills[half:], limiter, timeout))
+
+    async def _classify_batches_async(self, batches, concurrency, limiter, timeout):
+        client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url)
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def run(bills):
+            async with semaphore:
+                return await self._call_batch_async(client, bills, limiter, timeout)
+
+        try:
+            # gather 按 batches 的顺序返回结果，与请求完成的先后无关
+            return await asyncio.gather(*[run(bills) for bills in batches])
+        finally:
+            await client.close()
+
+    def classify_batches(self, batches, concurrency=4, requests_per_minute=0, tokens_per_minute=0, timeout=60):
+        """并发请求多个批次，返回与 batches 一一对应的分类列表
+
+        同时进行的请求不超过 concurrency 个，并按每分钟请求数、token 数限速（0 表示不限制）；
+        超时或失败的账单分类为空字符串
+        """
+        results = []
+        miss_batches = []
+        for bills in batches:
+            categories, miss_indexes = self._lookup_cache(bills)
+            results.append(categories)
+            if miss_indexes:
+                miss_batches.append((categories, miss_indexes, [bills[i] for i in miss_indexes]))
+        if not miss_batches:
+            return results
+
+        limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        miss_results = asyncio.run(self._classify_batches_async(
+            [miss_bills for _, _, miss_bills in miss_batches], concurrency, limiter, timeout))
+        for (categories, miss_indexes, miss_bills), miss_categories in zip(miss_batches, miss_results):
+            for i, category in zip(miss_indexes, miss_categories):
+                categories[i] = category
+            self._update_cache(miss_bills, miss_categories)
+        return results
+
     def get_token_count(self):
         return self.token_count
 
+    def get_cache_stats(self):
+        if self.cache is None:
+            return "disabled"
+        return self.cache.stats()
+
+    def save_cache(self):
+        if self.cache is not None:
+            self.cache.save()
+
 if __name__ == '__main__':
     from category import expense_category_mapping  # noqa: F403
     classifier = GPTClassifier()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import math
+import logging
+import argparse
+import configparser
+
+from bill_item import ClassifyAlg
+from category import ExpenseCategory, expense_category_mapping
+from classify_cache import normalize_text
+
+logger = logging.getLogger(__name__)
+
+# 历史账单明细页面的名称前缀
+DETAIL_SHEET_PREFIX = "账单明细 "
+
+# 不参与训练的分类：这些分类由规则和合并策略决定，不适合由模型猜测
+UNTRAINED_CATEGORIES = frozenset([
+    ExpenseCategory.UNKNOWN, ExpenseCategory.SKIP, ExpenseCategory.REFUND, ExpenseCategory.INCOME
+])
+
+# 不参与训练的分类算法：本地模型和 GPT 的结果未经人工复核，当作训练数据会把猜错的分类一再学回来；
+# 复核过的账单在分类算法列改为"人工标注"即可参与训练
+UNTRUSTED_ALGS = frozenset([ClassifyAlg.LOCAL.value, ClassifyAlg.GPT.value])
+
+def extract_features(item_name, payee, amount):
+    """payee 与 item_name 的字符 1-gram、2-gram，完整的 payee，以及按 2 的幂分桶的金额"""
+    features = []
+    for prefix, text in (('p', normalize_text(payee)), ('i', normalize_text(item_name))):
+        for i, ch in enumerate(text):
+            features.append(prefix + ':' + ch)
+            if i > 0:
+                features.append(prefix + ':' + text[i - 1:i + 1])
+    features.append('P=' + normalize_text(payee))
+    try:
+        features.append('a:{}'.format(int(math.log2(abs(float(amount)) + 1))))
+    except (TypeError, ValueError):
+        pass
+    return features
+
+class NaiveBayesClassifier:
+    """多项式朴素贝叶斯，只依赖标准库，几万条账单的训练和预测都在秒级完成"""
+
+    def __init__(self, alpha=1.0):
+        self.alpha = alpha
+        self.class_count = {}       # 分类 -> 样本数
+        self.feature_count = {}     # 分类 -> {特征: 次数}
+        self.feature_total = {}     # 分类 -> 特征总次数
+        self.vocabulary = set()
+
+    def __len__(self):
+        return sum(self.class_count.values())
+
+    def fit(self, samples):
+        """samples: (item_name, payee, amount, 分类字符串) 序列"""
+        for item_name, payee, amount, category in samples:
+            counts = self.feature_count.setdefault(category, {})
+            features = extract_features(item_name, payee, amount)
+            for feature in features:
+                counts[feature] = counts.get(feature, 0) + 1
+            self.vocabulary.update(features)
+            self.feature_total[category] = self.feature_total.get(category, 0) + len(features)
+            self.class_count[category] = self.class_count.get(category, 0) + 1
+        return self
+
+    def predict(self, item_name, payee, amount):
+        """返回 (分类字符串, 置信度)，没有训练数据或训练数据中没有这个 payee 时返回 ('', 0.0)
+
+        1-gram、2-gram 特征互相重叠，直接相乘会把同一份证据算很多次，后验概率几乎总是接近 1；
+        这里把对数似然除以 sqrt(特征数) 再做 softmax，使置信度与实际准确率大致相当
+        """
+        total = len(self)
+        if total == 0:
+            return '', 0.0
+        # 没见过的商家只能靠零散的字符猜测，准确率与随机猜测相当，交给 GPT
+        if 'P=' + normalize_text(payee) not in self.vocabulary:
+            return '', 0.0
+
+        features = [feature for feature in extract_features(item_name, payee, amount) if feature in self.vocabulary]
+        temperature = math.sqrt(len(features))
+        vocabulary_size = len(self.vocabulary)
+        scores = {}
+        for category, count in self.class_count.items():
+            counts = self.feature_count[category]
+            denominator = math.log(self.feature_total[category] + self.alpha * vocabulary_size)
+            likelihood = 0.0
+            for feature in features:
+                likelihood += math.log(counts.get(feature, 0) + self.alpha) - denominator
+            scores[category] = math.log(count / total) + likelihood / temperature
+
+        best = max(scores, key=scores.get)
+        best_score = scores[best]
+        # softmax 归一化得到置信度
+        norm = sum(math.exp(score - best_score) for score in scores.values())
+        return best, 1.0 / norm
+
+    def save(self, model_file):
+        model_dir = os.path.dirname(model_file)
+        if model_dir:
+            os.makedirs(model_dir, exist_ok=True)
+        tmp_file = "{}.{}.tmp".format(model_file, os.getpid())
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({
+                "alpha": self.alpha,
+                "class_count": self.class_count,
+                "feature_count": self.feature_count,
+            }, f, ensure_ascii=False)
+        os.replace(tmp_file, model_file)
+
+    @classmethod
+    def load(cls, model_file):
+        with open(model_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        model = cls(data["alpha"])
+        model.class_count = data["class_count"]
+        model.feature_count = data["feature_count"]
+        for category, counts in model.feature_count.items():
+            model.feature_total[category] = sum(counts.values())
+            model.vocabulary.update(counts)
+        return model
+
+def load_local_classifier(model_file):
+    """模型文件未配置或不存在时返回 None，跳过本地模型"""
+    if not model_file:
+        return None
+    try:
+        model = NaiveBayesClassifier.load(model_file)
+    except FileNotFoundError:
+        logger.warning("本地分类模型不存在: {}".format(model_file))
+        return None
+    except (ValueError, KeyError, TypeError, AttributeError) as err:
+        logger.warning("本地分类模型损坏，跳过本地模型 {}: {}".format(model_file, err))
+        return None
+    logger.info("加载本地分类模型，训练样本 {} 条: {}".format(len(model), model_file))
+    return model
+
+def iter_training_samples(rows):
+    """过滤账单明细中的行，rows: (item_name, payee, amount, 分类字符串, 分类算法字符串)"""
+    for item_name, payee, amount, category, classify_alg in rows:
+        if category not in expense_category_mapping:
+            continue
+        if expense_category_mapping[category] in UNTRAINED_CATEGORIES:
+            continue
+        if classify_alg in UNTRUSTED_ALGS:
+            continue
+        yield item_name, payee, amount, category
+
+def train_local_classifier(feishu_api, model_file):
+    """用账单表格中所有账单明细页面已标注的账单训练模型"""
+    sheet_info = feishu_api.GetSheetInfo()
+    model = NaiveBayesClassifier()
+    for sheet_name, info in sheet_info.items():
+        if not sheet_name.startswith(DETAIL_SHEET_PREFIX):
+            continue
+        ret, rows = feishu_api.GetLabeledBillRows(info['sheet_id'] + '!A:I')
+        if not ret:
+            logger.error("读取账单明细失败: {}".format(sheet_name))
+            return False, None
+        model.fit(iter_training_samples(rows))
+        logger.info("读取账单明细 {} 行: {}".format(len(rows), sheet_name))
+
+    model.save(model_file)
+    logger.info("本地分类模型训练完成，样本 {} 条: {}".format(len(model), model_file))
+    return True, model
+
+if __name__ == "__main__":
+    from feishu import FeishuSheetAPI, configure_feishu_session
+    from feishu_auth import FeishuAuthError, get_valid_user_access_token
+    from bill_config import BillConfig
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config_file', help='配置文件路径')
+    args = parser.parse_args()
+    config = configparser.ConfigParser()
+    config.read(args.config_file)
+    bill_config = BillConfig(config)
+    configure_feishu_session(bill_config.feishu_config.timeout, bill_config.feishu_config.max_retries)
+
+    try:
+        user_access_token = get_valid_user_access_token(config, args.config_file)
+    except FeishuAuthError as err:
+        logging.error(str(err))
+        raise SystemExit(1)
+
+    feishu_api = FeishuSheetAPI(user_access_token, bill_config.feishu_config.bill_sheet_token)
+    train_local_classifier(feishu_api, bill_config.strategy_config.local_model_file)
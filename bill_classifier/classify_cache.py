@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import unicodedata
+
+logger = logging.getLogger(__name__)
+
+def normalize_text(text):
+    """全角转半角、统一大小写、合并空白，让同一个商家/商品的不同写法命中同一条缓存"""
+    text = unicodedata.normalize('NFKC', str(text)).lower()
+    return re.sub(r'\s+', ' ', text).strip()
+
+class ClassifyCache:
+    """GPT 分类结果的磁盘缓存
+
+    key 由模型、提示词版本和归一化后的 item_name/payee 组成，模型或提示词变化后旧条目不再命中，
+    由过期时间和容量淘汰清理；超过 max_entries 条时按最近使用时间淘汰
+    """
+
+    def __init__(self, cache_file, ttl_seconds, max_entries):
+        self.cache_file = cache_file
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # key -> [分类, 写入时间, 最近使用时间]
+        self.entries = {}
+        self.hit_count = 0
+        self.miss_count = 0
+        self.dirty = False
+        self.load()
+
+    def cache_key(self, model, prompt_version, item_name, payee):
+        key = "{}\0{}\0{}\0{}".format(model, prompt_version, normalize_text(item_name), normalize_text(payee))
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def _expired(self, entry, now):
+        return self.ttl_seconds > 0 and now - entry[1] > self.ttl_seconds
+
+    def load(self):
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as err:
+            logger.warning("分类缓存损坏 {}: {}".format(self.cache_file, err))
+            return
+
+        now = time.time()
+        self.entries = {key: entry for key, entry in entries.items() if not self._expired(entry, now)}
+        self.dirty = len(self.entries) != len(entries)
+
+    def peek(self, model, prompt_version, item_name, payee):
+        """与 get() 相同，但不更新使用时间和命中计数"""
+        entry = self.entries.get(self.cache_key(model, prompt_version, item_name, payee))
+        if entry is None or self._expired(entry, time.time()):
+            return None
+        return entry[0]
+
+    def get(self, model, prompt_version, item_name, payee):
+        key = self.cache_key(model, prompt_version, item_name, payee)
+        entry = self.entries.get(key)
+        now = time.time()
+        if entry is None or self._expired(entry, now):
+            self.miss_count += 1
+            return None
+
+        entry[2] = now
+        self.dirty = True
+        self.hit_count += 1
+        return entry[0]
+
+    def put(self, model, prompt_version, item_name, payee, category):
+        now = time.time()
+        self.entries[self.cache_key(model, prompt_version, item_name, payee)] = [category, now, now]
+        self.dirty = True
+
+    def evict(self):
+        if self.max_entries <= 0 or len(self.entries) <= self.max_entries:
+            return
+        keys = sorted(self.entries, key=lambda key: self.entries[key][2])
+        for key in keys[:len(self.entries) - self.max_entries]:
+            del self.entries[key]
+        logger.info("淘汰分类缓存 {} 条".format(len(keys) - self.max_entries))
+
+    def save(self):
+        if not self.dirty:
+            return
+        self.evict()
+        cache_dir = os.path.dirname(self.cache_file)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = "{}.{}.tmp".format(self.cache_file, os.getpid())
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, ensure_ascii=False)
+        os.replace(tmp_file, self.cache_file)
+        self.dirty = False
+
+    def stats(self):
+        return "hit:{} miss:{}".format(self.hit_count, self.miss_count)
+
+def create_classify_cache(gpt_config):
+    if not gpt_config.cache_file:
+        return None
+    return ClassifyCache(gpt_config.cache_file, gpt_config.cache_ttl_days * 86400, gpt_config.cache_max_entries)
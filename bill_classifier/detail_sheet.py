@@ -2,22 +2,34 @@
 # -*- coding: utf-8 -*-
 
 import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
 from feishu import FeishuSheetAPI, FeishuUnit
 from category import ExpenseCategory, ExtraPayCategory
 from bill_item import ClassifyAlg
 
 logger = logging.getLogger(__name__)
 
+# 飞书单次写入不超过 5000 行，这里留出余量
+UPLOAD_CHUNK_ROWS = 2000
+
 class DetailSheet:
     """消费明细页面类，负责处理每月账单明细页面的构建和数据填充"""
 
-    def __init__(self, sheet_token, sheet_id, user_access_token, sheet_name):
+    def __init__(self, sheet_token, sheet_id, user_access_token, sheet_name,
+                 upload_chunk_rows=UPLOAD_CHUNK_ROWS, upload_workers=4):
         """初始化页面描述信息"""
         self.sheet_token = sheet_token
         self.sheet_id = sheet_id
         self.feishu_api = FeishuSheetAPI(user_access_token, sheet_token)
         self.sheet_name = sheet_name
 
+        # 写入账单数据时每次请求的行数、并发上传的分块数；失败重试由 FeishuSession 负责
+        self.upload_chunk_rows = max(1, min(upload_chunk_rows, UPLOAD_CHUNK_ROWS))
+        self.upload_workers = upload_workers
+
         # 列偏移量定义
         self.category_col_offset = 1  # 分类列偏移
         self.alg_col_offset = 8  # 分类算法列偏移
@@ -110,22 +122,60 @@ class DetailSheet:
             [category.value for category in ExtraPayCategory]
         )
 
+    def _data_range(self, start_pos, row_offset, row_size):
+        return "{}!{}{}:{}{}".format(
+            self.sheet_id,
+            start_pos.GetCol(),
+            start_pos.GetRow(offset=row_offset),
+            start_pos.GetCol(offset=self.data_col_size - 1),  # -1: offset 比长度小 1
+            start_pos.GetRow(offset=row_offset + row_size - 1)
+        )
+
+    def _record_chunk(self, sheet_range, bill_item_list):
+        try:
+            return self.feishu_api.RecordBillItem(sheet_range, bill_item_list)
+        except (requests.RequestException, ValueError, KeyError) as err:
+            logger.error("写入账单数据失败 sheet_range:{} err:{}".format(sheet_range, err))
+            return False
+
+    def _record_items(self, start_pos, bill_item_list):
+        """按 upload_chunk_rows 行分块写入，多个分块并发上传；失败的分块再逐个重试一次，不重新上传整个列表
+
+        FeishuSession 只重试限流、服务端错误和连接失败，其他飞书错误码由这里的一次重试兜底；
+        只重试一次，避免与 FeishuSession 的重试叠加后一个分块被请求几十次
+        """
+        chunks = []
+        for offset in range(0, len(bill_item_list), self.upload_chunk_rows):
+            chunk = bill_item_list[offset:offset + self.upload_chunk_rows]
+            chunks.append((self._data_range(start_pos, offset, len(chunk)), chunk))
+        if not chunks:
+            return True
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.upload_workers, len(chunks)))) as executor:
+            results = list(executor.map(lambda chunk: self._record_chunk(*chunk), chunks))
+
+        missing_ranges = []
+        for (sheet_range, chunk), ret in zip(chunks, results):
+            if ret:
+                continue
+            logger.warning("重试写入账单数据 sheet_range:{}".format(sheet_range))
+            if not self._record_chunk(sheet_range, chunk):
+                missing_ranges.append(sheet_range)
+
+        if missing_ranges:
+            logger.error("账单数据写入不完整，缺少 {} 个分块: {}".format(len(missing_ranges), ", ".join(missing_ranges)))
+            return False
+        return True
+
     def fill_data(self, bill_item_list, start_pos=None):
         """填充账单数据到页面"""
         if start_pos is None:
             start_pos = FeishuUnit('2', 'A')
 
         bill_size = len(bill_item_list)
-        sheet_range = "{}!{}{}:{}{}".format(
-            self.sheet_id,
-            start_pos.GetCol(),
-            start_pos.GetRow(),
-            start_pos.GetCol(offset=self.data_col_size - 1),  # -1: offset 比长度小 1
-            start_pos.GetRow(offset=bill_size - 1)
-        )
-        logger.info("bill_item sheet_range:{}".format(sheet_range))
+        logger.info("bill_item sheet_range:{}".format(self._data_range(start_pos, 0, bill_size)))
 
-        return self.feishu_api.RecordBillItem(sheet_range, bill_item_list)
+        return self._record_items(start_pos, bill_item_list)
 
     def fill_income_data(self, bill_item_list):
         """填充收入数据到页面（在支出数据右侧，间隔一列）"""
@@ -135,15 +185,6 @@ class DetailSheet:
 
         bill_size = len(bill_item_list)
         logger.info("income item 数量: {}".format(bill_size))
+        logger.info("income_item sheet_range:{}".format(self._data_range(income_pos, 0, bill_size)))
 
-        sheet_range = "{}!{}{}:{}{}".format(
-            self.sheet_id,
-            income_pos.GetCol(),
-            income_pos.GetRow(),
-            income_pos.GetCol(offset=self.data_col_size - 1),
-            income_pos.GetRow(offset=bill_size - 1)
-        )
-        logger.info("income_item sheet_range:{}".format(sheet_range))
-
-        return self.feishu_api.RecordBillItem(sheet_range, bill_item_list)
-
+        return self._record_items(income_pos, bill_item_list)
@@ -2,14 +2,17 @@ import logging
 import configparser
 import argparse
 
-from feishu import FeishuSheetAPI
+from feishu import FeishuSheetAPI, configure_feishu_session
 from feishu_auth import FeishuAuthError, get_valid_user_access_token
 from classifier_gpt import GPTClassifier
+from classify_cache import create_classify_cache
+from example_index import load_example_index
+from bill_config import BillConfig
 
 class ClassifierEvaluator:
-    def __init__(self, user_access_token, sheet_token, api_key):
+    def __init__(self, user_access_token, sheet_token, api_key, cache=None, example_index=None):
         self.feishu_api = FeishuSheetAPI(user_access_token, sheet_token)
-        self.classifier = GPTClassifier(api_key)
+        self.classifier = GPTClassifier(api_key, cache=cache, example_index=example_index)
         self.correct_count = 0
         self.error_count = 0
         self.error_items = []
@@ -42,6 +45,10 @@ class ClassifierEvaluator:
                     'predicted_category': predicted_category
                 })
 
+        self.classifier.save_cache()
+        logging.info("gpt cost token:{} cache {}".format(self.classifier.get_token_count(),
+                                                         self.classifier.get_cache_stats()))
+
         # 3. 计算正确率
         total = self.correct_count + self.error_count
         accuracy = self.correct_count / total if total > 0 else 0.0
@@ -71,7 +78,12 @@ def main():
         return
 
     # 创建评测器
-    evaluator = ClassifierEvaluator(user_access_token, sheet_token, api_key)
+    bill_config = BillConfig(config)
+    configure_feishu_session(bill_config.feishu_config.timeout, bill_config.feishu_config.max_retries)
+    gpt_config = bill_config.gpt_config
+    cache = create_classify_cache(gpt_config)
+    evaluator = ClassifierEvaluator(user_access_token, sheet_token, api_key, cache,
+                                    load_example_index(gpt_config.example_index_file))
 
     # 执行评测
     correct, error, accuracy, error_items = evaluator.evaluate('ad3acc')
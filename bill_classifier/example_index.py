@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import math
+import heapq
+import logging
+import argparse
+import configparser
+
+from classify_cache import normalize_text
+from classifier_local import DETAIL_SHEET_PREFIX, iter_training_samples
+
+logger = logging.getLogger(__name__)
+
+# 索引文件格式或示例的筛选规则变化时需要修改，旧文件会被丢弃并重新读取所有账单明细页面
+INDEX_FORMAT = 2
+
+def text_grams(item_name, payee):
+    """payee 与 item_name 的字符 2-gram（单字时取 1-gram），分字段加前缀"""
+    grams = set()
+    for prefix, text in (('p', normalize_text(payee)), ('i', normalize_text(item_name))):
+        if len(text) == 1:
+            grams.add(prefix + ':' + text)
+        for i in range(1, len(text)):
+            grams.add(prefix + ':' + text[i - 1:i + 1])
+    return grams
+
+class ExampleIndex:
+    """已标注历史账单的倒排索引，为 GPT 提示词检索相似的示例
+
+    按 n-gram 建倒排表，检索时只遍历查询中 n-gram 的倒排表，按 idf 加权的重合度打分；
+    出现次数超过 max_postings 的 n-gram 区分度低，检索时跳过，保证单次检索在毫秒级
+    """
+
+    def __init__(self, max_postings=2000):
+        self.max_postings = max_postings
+        self.examples = []          # [item_name, payee, 分类字符串]
+        self.example_keys = {}      # 归一化的 (item_name, payee) -> 示例下标
+        self.example_norms = []
+        self.postings = {}          # n-gram -> 示例下标列表
+        # 已加入索引的账单明细页面，重建索引时只读取新页面
+        self.sheets = set()
+
+    def __len__(self):
+        return len(self.examples)
+
+    def add(self, item_name, payee, category):
+        """加入一条示例，相同 item_name/payee 的示例只保留最新的分类"""
+        key = (normalize_text(item_name), normalize_text(payee))
+        index = self.example_keys.get(key)
+        if index is not None:
+            self.examples[index][2] = category
+            return
+
+        index = len(self.examples)
+        self.example_keys[key] = index
+        self.examples.append([item_name, payee, category])
+        grams = text_grams(item_name, payee)
+        self.example_norms.append(math.sqrt(len(grams)) or 1.0)
+        for gram in grams:
+            self.postings.setdefault(gram, []).append(index)
+
+    def add_samples(self, samples):
+        for item_name, payee, _, category in samples:
+            self.add(item_name, payee, category)
+
+    def search(self, item_name, payee, k=3, categories=None):
+        """返回最相似的 k 条示例 [(item_name, payee, 分类字符串)]
+
+        categories 不为 None 时只返回分类在其中的示例
+        """
+        total = len(self.examples)
+        scores = {}
+        for gram in text_grams(item_name, payee):
+            posting = self.postings.get(gram)
+            if not posting or len(posting) > self.max_postings:
+                continue
+            idf = math.log(total / len(posting)) + 1.0
+            for index in posting:
+                scores[index] = scores.get(index, 0.0) + idf
+
+        candidates = scores.items()
+        if categories is not None:
+            candidates = [score for score in candidates if self.examples[score[0]][2] in categories]
+        best = heapq.nlargest(k, candidates, key=lambda score: score[1] / self.example_norms[score[0]])
+        return [tuple(self.examples[index]) for index, _ in best]
+
+    def save(self, index_file):
+        index_dir = os.path.dirname(index_file)
+        if index_dir:
+            os.makedirs(index_dir, exist_ok=True)
+        tmp_file = "{}.{}.tmp".format(index_file, os.getpid())
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({"format": INDEX_FORMAT, "sheets": sorted(self.sheets), "examples": self.examples}, f,
+                      ensure_ascii=False)
+        os.replace(tmp_file, index_file)
+
+    @classmethod
+    def load(cls, index_file):
+        """文件中只保存示例，倒排表在加载时重建；文件格式不一致时返回 None"""
+        with open(index_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get("format") != INDEX_FORMAT:
+            return None
+        index = cls()
+        for item_name, payee, category in data["examples"]:
+            index.add(item_name, payee, category)
+        index.sheets = set(data["sheets"])
+        return index
+
+def load_example_index(index_file):
+    """索引文件未配置或不存在时返回 None，提示词中不带示例"""
+    if not index_file:
+        return None
+    try:
+        index = ExampleIndex.load(index_file)
+    except FileNotFoundError:
+        logger.warning("示例索引不存在: {}".format(index_file))
+        return None
+    except (ValueError, KeyError, TypeError, AttributeError) as err:
+        logger.warning("示例索引损坏，提示词中不带示例 {}: {}".format(index_file, err))
+        return None
+    if index is None:
+        logger.warning("示例索引格式已变化，需要重新生成: {}".format(index_file))
+        return None
+    logger.info("加载示例索引 {} 条: {}".format(len(index), index_file))
+    return index
+
+def update_example_index(feishu_api, index_file, current_sheet=''):
+    """把尚未加入索引的账单明细页面加入索引
+
+    current_sheet 是仍在修改的当月页面，每次都会重新读取
+    """
+    index = load_example_index(index_file) or ExampleIndex()
+    sheet_info = feishu_api.GetSheetInfo()
+    for sheet_name, info in sheet_info.items():
+        if not sheet_name.startswith(DETAIL_SHEET_PREFIX):
+            continue
+        if sheet_name in index.sheets and sheet_name != current_sheet:
+            continue
+        ret, rows = feishu_api.GetLabeledBillRows(info['sheet_id'] + '!A:I')
+        if not ret:
+            logger.error("读取账单明细失败: {}".format(sheet_name))
+            return False, None
+        index.add_samples(iter_training_samples(rows))
+        index.sheets.add(sheet_name)
+        logger.info("加入示例索引 {} 行: {}".format(len(rows), sheet_name))
+
+    index.save(index_file)
+    logger.info("示例索引更新完成，共 {} 条: {}".format(len(index), index_file))
+    return True, index
+
+if __name__ == "__main__":
+    from feishu import FeishuSheetAPI, configure_feishu_session
+    from feishu_auth import FeishuAuthError, get_valid_user_access_token
+    from bill_config import BillConfig
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config_file', help='配置文件路径')
+    parser.add_argument('--current_sheet', default='', help='需要重新读取的账单明细页面，例如 "账单明细 202403"')
+    args = parser.parse_args()
+    config = configparser.ConfigParser()
+    config.read(args.config_file)
+    bill_config = BillConfig(config)
+    configure_feishu_session(bill_config.feishu_config.timeout, bill_config.feishu_config.max_retries)
+
+    try:
+        user_access_token = get_valid_user_access_token(config, args.config_file)
+    except FeishuAuthError as err:
+        logging.error(str(err))
+        raise SystemExit(1)
+
+    feishu_api = FeishuSheetAPI(user_access_token, bill_config.feishu_config.bill_sheet_token)
+    update_example_index(feishu_api, bill_config.gpt_config.example_index_file, args.current_sheet)
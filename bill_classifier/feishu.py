@@ -1,7 +1,10 @@
 import requests
 import json
+import time
+import random
 import datetime
 import logging
+from requests.adapters import HTTPAdapter
 from itertools import cycle
 from category import expense_category_mapping, ExpenseCategory
 from bill_item import ClassifyAlg
@@ -35,27 +38,97 @@ class FeishuUnit:
 
         return str(new_row)
 
+# 飞书接口频率限制的错误码，请求未被处理，可以安全重试
+FEISHU_RATE_LIMIT_CODES = (99991400, 90217)
+# 服务端错误时只重试幂等的请求，POST（新增页面、行列等）重试可能重复执行
+IDEMPOTENT_METHODS = ('GET', 'PUT')
+
+class FeishuSession:
+    """所有 FeishuSheetAPI 共用的 HTTP 会话：连接池复用 TLS 连接，统一超时，失败时带抖动的指数退避重试"""
+
+    def __init__(self, timeout=10, max_retries=3, backoff=0.5, pool_size=8):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _should_retry(self, method, response):
+        if response.status_code == 429:
+            return True
+        if response.status_code >= 500:
+            return method in IDEMPOTENT_METHODS
+        try:
+            return response.json().get('code') in FEISHU_RATE_LIMIT_CODES
+        except ValueError:
+            return False
+
+    def _sleep(self, attempt):
+        time.sleep(self.backoff * (2 ** attempt) * (0.5 + random.random()))
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as err:
+                if attempt >= self.max_retries or method not in IDEMPOTENT_METHODS:
+                    raise
+                logging.warning("飞书请求失败，重试 {}/{}: {} {}".format(attempt + 1, self.max_retries, url, err))
+            else:
+                if attempt >= self.max_retries or not self._should_retry(method, response):
+                    return response
+                logging.warning("飞书请求被限流或服务端错误，重试 {}/{}: {} status:{}".format(
+                    attempt + 1, self.max_retries, url, response.status_code))
+            self._sleep(attempt)
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+_feishu_session = None
+
+def configure_feishu_session(timeout=10, max_retries=3):
+    """按配置创建进程内共用的会话，需要在创建 FeishuSheetAPI 之前调用"""
+    global _feishu_session
+    _feishu_session = FeishuSession(timeout, max_retries)
+    return _feishu_session
+
+def get_feishu_session():
+    global _feishu_session
+    if _feishu_session is None:
+        _feishu_session = FeishuSession()
+    return _feishu_session
+
 class FeishuSheetAPI:
     unit_color = [
         "#BACEFD", "#FED4A4", "#F76964", "#F8E6AB", "#A9EFE6",
         "#FDE2E2", "#ECE2FE", "#D9F5D6", "#F8DEF8", "#EEF6C6"
     ]
 
-    def __init__(self, user_access_token, sheet_token):
+    def __init__(self, user_access_token, sheet_token, session=None):
         self.user_access_token = user_access_token
         self.sheet_token = sheet_token
-
-    def GetSheetInfo(self):
-        url = "https://open.feishu.cn/open-apis/sheets/v3/spreadsheets/{}/sheets/query".format(self.sheet_token)
-
-        # 设置请求头
-        headers = {
+        self.session = session or get_feishu_session()
+        self.headers = {
             'Content-Type': 'application/json',
             'Authorization': 'Bearer ' + self.user_access_token
         }
 
+    def GetSheetInfo(self):
+        url = "https://open.feishu.cn/open-apis/sheets/v3/spreadsheets/{}/sheets/query".format(self.sheet_token)
+
         # 发送请求并获取响应
-        response = requests.get(url, headers=headers)
+        response = self.session.get(url, headers=self.headers)
 
         rsp = json.loads(response.text)
 
@@ -93,14 +166,8 @@ class FeishuSheetAPI:
                 }]
         }
 
-        # 设置请求头
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer ' + self.user_access_token
-        }
-
         # 发送请求并获取响应
-        response = requests.post(url, json=data, headers=headers)
+        response = self.session.post(url, json=data, headers=self.headers)
 
         rsp = json.loads(response.text)
 
@@ -138,14 +205,8 @@ class FeishuSheetAPI:
             }
         }
 
-        # 设置请求头
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer ' + self.user_access_token
-        }
-
         # 发送请求并获取响应
-        response = requests.post(url, json=data, headers=headers)
+        response = self.session.post(url, json=data, headers=self.headers)
 
         rsp = json.loads(response.text)
 
@@ -167,14 +228,8 @@ class FeishuSheetAPI:
             }
         }
 
-        # 设置请求头
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer ' + self.user_access_token
-        }
-
         # 发送请求并获取响应
-        response = requests.post(url, json=data, headers=headers)
+        response = self.session.post(url, json=data, headers=self.headers)
 
         rsp = json.loads(response.text)
 
@@ -202,14 +257,8 @@ class FeishuSheetAPI:
             }
         }
 
-        # 设置请求头
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer ' + self.user_access_token
-        }
-
         # 发送请求并获取响应
-        response = requests.post(url, json=data, headers=headers)
+        response = self.session.post(url, json=data, headers=self.headers)
 
         rsp = json.loads(response.text)
 
@@ -245,14 +294,8 @@ class FeishuSheetAPI:
 
             data['valueRange']['values'].append(line_data)
 
-        # 设置请求头
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer ' + self.user_access_token
-        }
-
         # 发送请求并获取响应
-        response = requests.put(url, json=data, headers=headers)
+        response = self.session.put(url, json=data, headers=self.headers)
 
         rsp = json.loads(response.text)
         if rsp['code'] != 0:
@@ -309,14 +352,8 @@ class FeishuSheetAPI:
                     }])
         print(data)
 
-        # 设置请求头
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer ' + self.user_access_token
-        }
-
         # 发送请求并获取响应
-        response = requests.put(url, json=data, headers=headers)
+        response = self.session.put(url, json=data, headers=self.headers)
 
         rsp = json.loads(response.text)
         if rsp['code'] != 0:
@@ -328,17 +365,11 @@ class FeishuSheetAPI:
     def GetMonthSheetInfoLineTitle(self, month_sheet_id):
         url = "https://open.feishu.cn/open-apis/sheets/v2/spreadsheets/{}/values/{}".format(self.sheet_token, "{}!A:A".format(month_sheet_id))
 
-        # 设置请求头
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer ' + self.user_access_token
-        }
-
         params = {
             "valueRenderOption": "ToString"
         }
 
-        response = requests.get(url, params=params, headers=headers)
+        response = self.session.get(url, params=params, headers=self.headers)
         rsp = json.loads(response.text)
 
         if rsp['code'] != 0:
@@ -365,14 +396,8 @@ class FeishuSheetAPI:
             ]
         }
 
-        # 设置请求头
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer ' + self.user_access_token
-        }
-
         # 发送请求并获取响应
-        response = requests.put(url, json=data, headers=headers)
+        response = self.session.put(url, json=data, headers=self.headers)
 
         rsp = json.loads(response.text)
         if rsp['code'] != 0:
@@ -392,12 +417,7 @@ class FeishuSheetAPI:
             }
         }
 
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer ' + self.user_access_token
-        }
-
-        response = requests.put(url, json=data, headers=headers)
+        response = self.session.put(url, json=data, headers=self.headers)
         rsp = json.loads(response.text)
 
         if rsp['code'] != 0:
@@ -424,12 +444,7 @@ class FeishuSheetAPI:
             }]
         }
 
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer ' + self.user_access_token
-        }
-
-        response = requests.put(url, json=data, headers=headers)
+        response = self.session.put(url, json=data, headers=self.headers)
         rsp = json.loads(response.text)
 
         if rsp['code'] != 0:
@@ -452,44 +467,96 @@ class FeishuSheetAPI:
     def GetCategoryClassificationInfo(self, value_range):
         url = "https://open.feishu.cn/open-apis/sheets/v2/spreadsheets/{}/values/{}".format(self.sheet_token, value_range)
 
-        # 设置请求头
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer ' + self.user_access_token
-        }
-
         params = {
             "valueRenderOption": "ToString"
         }
 
-        response = requests.get(url, params=params, headers=headers)
+        response = self.session.get(url, params=params, headers=self.headers)
         rsp = json.loads(response.text)
 
         if rsp['code'] != 0:
             logging.error("GetCategoryClassificationInfo error code:{} msg:{}".format(rsp['code'], rsp['msg']))
             return False, {}
 
-        values = rsp['data']['valueRange']['values']
+        return True, self._category_value_map(rsp['data']['valueRange']['values'])
+
+    def _category_value_map(self, values):
         value_map = {}
         for value in values[1:]:
             key = str(value[0])
             category = expense_category_mapping[value[1]]
             value_map[key] = category
+        return value_map
 
-        return True, value_map
+    def GetSpreadsheetRevision(self):
+        """查询表格的版本号，表格内容每次修改后版本号都会增加"""
+        url = "https://open.feishu.cn/open-apis/sheets/v2/spreadsheets/{}/metainfo".format(self.sheet_token)
 
-    def GetClassificationTestData(self, value_range):
+        response = self.session.get(url, headers=self.headers)
+        rsp = json.loads(response.text)
+
+        if rsp['code'] != 0:
+            logging.error("GetSpreadsheetRevision error code:{} msg:{}".format(rsp['code'], rsp['msg']))
+            return False, 0
+
+        return True, rsp['data']['properties']['revision']
+
+    def GetCategoryClassificationInfoBatch(self, value_ranges):
+        """一次请求读取多个分类字典区域，返回与 value_ranges 顺序一致的字典列表"""
+        url = "https://open.feishu.cn/open-apis/sheets/v2/spreadsheets/{}/values_batch_get".format(self.sheet_token)
+
+        params = {
+            "ranges": ",".join(value_ranges),
+            "valueRenderOption": "ToString"
+        }
+
+        response = self.session.get(url, params=params, headers=self.headers)
+        rsp = json.loads(response.text)
+
+        if rsp['code'] != 0:
+            logging.error("GetCategoryClassificationInfoBatch error code:{} msg:{}".format(rsp['code'], rsp['msg']))
+            return False, []
+
+        value_ranges_rsp = rsp['data']['valueRanges']
+        if len(value_ranges_rsp) != len(value_ranges):
+            logging.error("GetCategoryClassificationInfoBatch response format error rsp:{}".format(rsp))
+            return False, []
+
+        return True, [self._category_value_map(value_range.get('values') or []) for value_range in value_ranges_rsp]
+
+    def GetLabeledBillRows(self, value_range):
+        """读取账单明细页面 A:I 列，返回 (item_name, payee, amount, 分类字符串, 分类算法字符串) 列表，跳过表头"""
         url = "https://open.feishu.cn/open-apis/sheets/v2/spreadsheets/{}/values/{}".format(self.sheet_token, value_range)
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer ' + self.user_access_token
+        params = {
+            "valueRenderOption": "ToString"
         }
 
+        response = self.session.get(url, params=params, headers=self.headers)
+        rsp = json.loads(response.text)
+
+        if rsp['code'] != 0:
+            logging.error("GetLabeledBillRows error code:{} msg:{}".format(rsp['code'], rsp['msg']))
+            return False, []
+
+        values = rsp['data']['valueRange'].get('values') or []
+        rows = []
+        for value in values[1:]:
+            if len(value) < 4 or value[1] is None:
+                continue
+            amount, category, payee, item_name = value[:4]
+            # 早期的明细页可能没有分类算法列
+            classify_alg = value[8] if len(value) > 8 else None
+            rows.append((str(item_name or ''), str(payee or ''), amount, str(category), str(classify_alg or '')))
+
+        return True, rows
+
+    def GetClassificationTestData(self, value_range):
+        url = "https://open.feishu.cn/open-apis/sheets/v2/spreadsheets/{}/values/{}".format(self.sheet_token, value_range)
         params = {
             "valueRenderOption": "ToString"
         }
 
-        response = requests.get(url, params=params, headers=headers)
+        response = self.session.get(url, params=params, headers=self.headers)
         rsp = json.loads(response.text)
 
         if rsp['code'] != 0:
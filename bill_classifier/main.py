@@ -7,13 +7,17 @@ import datetime
 import sys
 import configparser
 import argparse
+import functools
+import heapq
 import openai
+from concurrent.futures import ProcessPoolExecutor
 
-from feishu import FeishuSheetAPI
+from feishu import FeishuSheetAPI, configure_feishu_session
 from feishu_auth import FeishuAuthError, get_valid_user_access_token
 from category import ExpenseCategory
 from bill_item import BillType, ClassifyAlg
-from bill import AliPayBill, WeChatBill
+from bill import parse_bill_file, bill_time_key
+from bill_cache import create_bill_cache, dumps_bill_columns, loads_bill_columns
 from bill_config import BillConfig
 from bill_file import BillFile
 from strategy import bill_strategy
@@ -43,7 +47,8 @@ def record_to_feishu(feishu_config, bill_item_dict):
         sheet_id = sheet_info[sheet_name]['sheet_id']
 
     # 初始化页面类
-    detail_sheet = DetailSheet(bill_sheet_token, sheet_id, user_access_token, sheet_name)
+    detail_sheet = DetailSheet(bill_sheet_token, sheet_id, user_access_token, sheet_name,
+                               feishu_config.upload_chunk_rows, feishu_config.upload_workers)
     summary_sheet = SummarySheet(bill_sheet_token, sheet_id, user_access_token)
     
     # 处理支出数据
@@ -56,8 +61,10 @@ def record_to_feishu(feishu_config, bill_item_dict):
     if bill_size > 0:
         detail_sheet.init_sheet(bill_size)
 
-        # 填充支出数据
-        detail_sheet.fill_data(bill_item_dict['expense'])
+        # 填充支出数据，明细页缺少部分账单时汇总页的公式结果也是错的，不再更新汇总页
+        if not detail_sheet.fill_data(bill_item_dict['expense']):
+            logging.error("账单明细写入不完整，未更新汇总页面，请重新运行: {}".format(sheet_name))
+            return False
 
     # 处理收入数据
     # if 'income' in bill_item_dict and len(bill_item_dict['income']) > 0:
@@ -72,6 +79,7 @@ def record_to_feishu(feishu_config, bill_item_dict):
         sheet_name,
         expense_size
     )
+    return True
 
 def check_unknown_items(bill_item_list):
     count = 0
@@ -93,15 +101,103 @@ def load_bill_file(config):
         if not config.has_section(section_name):
             break
         file_name = config.get(section_name, "name")
-        bill_type = config.get(section_name, "type")
+        # 未配置 type 时根据账单表头自动识别
+        bill_type = config.get(section_name, "type", fallback="auto")
         bill_owner = config.get(section_name, "owner")
+        member = config.get(section_name, "member", fallback="")
+        password = config.get(section_name, "password", fallback="")
 
-        bill_file = BillFile(file_name, bill_owner, bill_type)
+        bill_file = BillFile(file_name, bill_owner, bill_type, member, password)
         bill_files.append(bill_file)
         i = i + 1
 
     return bill_files
 
+def iter_bill_streams(bill_files, bill_cache=None):
+    """按 bill_files 顺序逐个解析账单文件，产出每个文件按时间升序排列的 BillItem 列表"""
+    for bill_file in bill_files:
+        yield parse_bill_file(bill_file, bill_cache)
+
+def parse_bill_file_columns(bill_file, bill_cache=None):
+    """在 worker 进程中解析账单文件，返回按列序列化的结果"""
+    return dumps_bill_columns(parse_bill_file(bill_file, bill_cache))
+
+def iter_bill_streams_parallel(bill_files, workers, bill_cache=None):
+    """多进程并发解析账单文件，按 bill_files 的顺序产出每个文件的 BillItem 列表
+
+    worker 只传回几个数值列的 bytes 和字符串列表，不 pickle 大量 BillItem 对象，
+    主进程再按列重建 BillItem；executor.map 保证结果顺序与 bill_files 一致
+    """
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(bill_files))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for data in executor.map(functools.partial(parse_bill_file_columns, bill_cache=bill_cache), bill_files):
+            yield loads_bill_columns(data)
+
+# 明细页中各类账单的排列顺序
+BUCKET_EXPENSE = 0
+BUCKET_REGULAR = 1
+BUCKET_WET_MARKET = 2
+BUCKET_LOCAL = 3
+BUCKET_GPT = 4
+BUCKET_UNKNOWN = 5
+BUCKET_OTHER = 6
+BUCKET_SKIP = 7
+BUCKET_INCOME = 8
+
+def split_bill_items(bill_item_list):
+    """按收支类型和分类结果给账单分桶，返回明细页的支出列表和收入列表"""
+    alg_bucket = {
+        ClassifyAlg.GPT: BUCKET_GPT,
+        ClassifyAlg.REGULAR: BUCKET_REGULAR,
+        ClassifyAlg.WET_MARKET: BUCKET_WET_MARKET,
+        # 本地模型猜测的分类与模糊匹配、GPT 一样需要人工复核，不能混在完全匹配的账单中
+        ClassifyAlg.LOCAL: BUCKET_LOCAL,
+    }
+
+    buckets = [[] for _ in range(BUCKET_INCOME + 1)]
+    for bill_item in bill_item_list:
+        if bill_item.bill_type == BillType.INCOME:
+            bucket = BUCKET_INCOME
+        elif bill_item.bill_type == BillType.OTHER:
+            bucket = BUCKET_OTHER
+        elif bill_item.category == ExpenseCategory.UNKNOWN:
+            bucket = BUCKET_UNKNOWN
+        elif bill_item.classify_alg in alg_bucket:
+            bucket = alg_bucket[bill_item.classify_alg]
+        elif bill_item.category == ExpenseCategory.BUY_VEGETABLES:
+            bucket = BUCKET_WET_MARKET
+        elif bill_item.category == ExpenseCategory.SKIP or bill_item.amount == 0.0:
+            bucket = BUCKET_SKIP
+        else:
+            bucket = BUCKET_EXPENSE
+        buckets[bucket].append(bill_item)
+
+    return {
+        "expense": [bill_item for bucket in buckets for bill_item in bucket],
+        "income": buckets[BUCKET_INCOME],
+    }
+
+def load_bill_items(bill_files, workers=1, bill_cache=None):
+    """解析所有账单文件，把各文件按时间升序的 BillItem 列表 k 路归并成一个有序的流
+
+    时间相同的账单按 bill_files 的顺序排列，与先拼接再稳定排序的结果一致
+    """
+    if workers == 1 or len(bill_files) <= 1:
+        bill_streams = iter_bill_streams(bill_files, bill_cache)
+    else:
+        bill_streams = iter_bill_streams_parallel(bill_files, workers, bill_cache)
+
+    item_lists = []
+    for bill_file, item_list in zip(bill_files, bill_streams):
+        logging.info("{} {} bill item:{}".format(bill_file.bill_owner, bill_file.bill_type, len(item_list)))
+        item_lists.append(item_list)
+    logging.info("all bill item:{}".format(sum(len(item_list) for item_list in item_lists)))
+
+    return heapq.merge(*item_lists, key=bill_time_key)
+
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
@@ -115,6 +211,7 @@ if __name__ == "__main__":
     config.read(args.config_file)
 
     bill_config = BillConfig(config)
+    configure_feishu_session(bill_config.feishu_config.timeout, bill_config.feishu_config.max_retries)
     try:
         bill_config.feishu_config.user_access_token = get_valid_user_access_token(config, args.config_file)
     except FeishuAuthError as err:
@@ -126,74 +223,16 @@ if __name__ == "__main__":
     bill_files = load_bill_file(config)
     logging.debug("bill_files:{}".format(len(bill_files)))
 
-    bill_item_list = []
-
-    for bill_file in bill_files:
-        bill = None
-        if bill_file.bill_type == "alipay":
-            bill = AliPayBill(bill_file)
-        elif bill_file.bill_type == "wechat":
-            bill = WeChatBill(bill_file)
-
-        item_list = []
-        bill.parse_from_file(item_list)
-
-        logging.info("{} {} bill item:{}".format(bill.owner, bill.bill_type, len(item_list)))
-
-        bill_item_list.extend(item_list)
-
-    logging.info("all bill item:{}".format(len(bill_item_list)))
-
-    ret, bill_item_list = bill_strategy(bill_item_list, bill_config)
+    bill_cache = create_bill_cache(bill_config.parse_config)
+    bill_items = load_bill_items(bill_files, bill_config.parse_config.workers, bill_cache)
+    ret, bill_item_list = bill_strategy(bill_items, bill_config)
     if not ret:
         sys.exit()
 
     logging.info("标记类型后 item:{}".format(len(bill_item_list)))
 
     # 拆分数据
-    income_data = []
-    expense_data = []
-    other_data = []
-    skip_data = []
-    unknown_data = []
-    gpt_data = []
-    regular_data = []
-    wet_market_data = []
-    for bill_item in bill_item_list:
-        if bill_item.bill_type == BillType.INCOME:
-            income_data.append(bill_item)
-        elif bill_item.bill_type == BillType.OTHER:
-            other_data.append(bill_item)
-        else:  # EXPENSE
-            if bill_item.category == ExpenseCategory.UNKNOWN:
-                unknown_data.append(bill_item)
-            elif bill_item.classify_alg == ClassifyAlg.GPT:
-                gpt_data.append(bill_item)
-            elif bill_item.classify_alg == ClassifyAlg.REGULAR:
-                regular_data.append(bill_item)
-            elif bill_item.classify_alg == ClassifyAlg.WET_MARKET:
-                wet_market_data.append(bill_item)
-            elif bill_item.category == ExpenseCategory.BUY_VEGETABLES:
-                wet_market_data.append(bill_item)
-            elif bill_item.category == ExpenseCategory.SKIP:
-                skip_data.append(bill_item)
-            else:
-                if bill_item.amount == 0.0:
-                    skip_data.append(bill_item)
-                else:
-                    expense_data.append(bill_item)
-
-    expense_data.extend(regular_data)
-    expense_data.extend(wet_market_data)
-    expense_data.extend(gpt_data)
-    expense_data.extend(unknown_data)
-    expense_data.extend(other_data)
-    expense_data.extend(skip_data)
-    expense_data.extend(income_data)
-
-    bill_item_dict = {
-        "expense": expense_data,
-        "income": income_data,
-    }
+    bill_item_dict = split_bill_items(bill_item_list)
 
-    record_to_feishu(bill_config.feishu_config, bill_item_dict)
+    if not record_to_feishu(bill_config.feishu_config, bill_item_dict):
+        sys.exit(1)
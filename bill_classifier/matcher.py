@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+class SubstringMatcher:
+    """把 {子串: 值} 字典编译成 Aho-Corasick 自动机
+
+    match(text) 只扫描一遍 text，返回 text 中出现的子串里在字典中排在最前的那个子串的值，
+    与按字典顺序逐个判断 `key in text` 并取第一个命中的结果一致
+    """
+
+    NO_MATCH = -1
+
+    def __init__(self, pattern_dict):
+        self.values = list(pattern_dict.values())
+        self.goto = [{}]
+        self.fail = [0]
+        # best[state]: 在 state 结束的所有子串（含 fail 链上的后缀）中最小的字典序号
+        self.best = [self.NO_MATCH]
+
+        for index, pattern in enumerate(pattern_dict):
+            state = 0
+            for ch in pattern:
+                next_state = self.goto[state].get(ch)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][ch] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.best.append(self.NO_MATCH)
+                state = next_state
+            if self.best[state] == self.NO_MATCH:
+                self.best[state] = index
+
+        self._build_fail()
+
+    def _better(self, a, b):
+        if a == self.NO_MATCH:
+            return b
+        if b == self.NO_MATCH:
+            return a
+        return min(a, b)
+
+    def _build_fail(self):
+        queue = list(self.goto[0].values())
+        for state in queue:
+            self.best[state] = self._better(self.best[state], self.best[0])
+        head = 0
+        while head < len(queue):
+            state = queue[head]
+            head += 1
+            for ch, next_state in self.goto[state].items():
+                fail_state = self.fail[state]
+                while fail_state and ch not in self.goto[fail_state]:
+                    fail_state = self.fail[fail_state]
+                self.fail[next_state] = self.goto[fail_state].get(ch, 0)
+                self.best[next_state] = self._better(self.best[next_state], self.best[self.fail[next_state]])
+                queue.append(next_state)
+
+    def __len__(self):
+        return len(self.values)
+
+    def to_state(self):
+        """返回只包含 list/dict/int/str 的编译结果，可以直接用 marshal 序列化（values 需要是基本类型）"""
+        return (self.goto, self.fail, self.best, self.values)
+
+    @classmethod
+    def from_state(cls, state):
+        """从 to_state() 的结果恢复，不重新构建自动机"""
+        matcher = cls.__new__(cls)
+        matcher.goto, matcher.fail, matcher.best, matcher.values = state
+        return matcher
+
+    def match_index(self, text):
+        """返回命中的子串在字典中的序号，没有命中时返回 NO_MATCH"""
+        goto = self.goto
+        fail = self.fail
+        best = self.best
+        result = best[0]  # 空字符串子串会命中任意 text
+        if result == 0:
+            return result
+
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            index = best[state]
+            if index != self.NO_MATCH and (result == self.NO_MATCH or index < result):
+                result = index
+                if result == 0:
+                    break
+        return result
+
+    def match(self, text, default=None):
+        index = self.match_index(text)
+        if index == self.NO_MATCH:
+            return default
+        return self.values[index]
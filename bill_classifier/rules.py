@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+规则文件格式（json）：
+{
+    "rules": [
+        {
+            "name": "规则说明",
+            "when": {                       # 所有条件同时满足时命中，省略表示匹配所有账单
+                "payee": "完全匹配的值" 或 ["值1", "值2"],
+                "payee_regex": "从开头匹配的正则",
+                "payee_contains": "包含的子串",
+                "item_name" / "item_name_regex" / "item_name_contains": 同上,
+                "weekday": [0, 1, 2, 3, 4], # 0 是周一
+                "hour": [18, 21]
+            },
+            "action": "skip" | "categorize" | "merge" | "exclude",
+            "category": "餐饮",             # categorize 时的分类
+            "group_by": "owner",            # merge 时的分组字段
+            "fallback": true                # skip/categorize 只对字典匹配后仍未识别的账单生效
+        }
+    ]
+}
+
+skip/categorize 在合并前生效；merge 合并同组账单；exclude 的账单不交给 GPT 分类。
+每种动作按规则顺序取第一条命中的规则。
+"""
+
+import re
+import json
+import logging
+import datetime
+
+from bill_item import BillItem
+from category import ExpenseCategory, expense_category_mapping
+
+logger = logging.getLogger(__name__)
+
+ACTIONS = ('skip', 'categorize', 'merge', 'exclude')
+MATCH_FIELDS = ('payee', 'item_name')
+
+class Rule:
+    def __init__(self, index, config):
+        self.index = index
+        self.name = config.get('name', '')
+        self.action = config.get('action')
+        if self.action not in ACTIONS:
+            raise ValueError("规则 {} 的 action 无效: {}".format(index, self.action))
+
+        self.fallback = bool(config.get('fallback', False))
+        self.category = None
+        if self.action == 'skip':
+            self.category = ExpenseCategory.SKIP
+        elif self.action == 'categorize':
+            self.category = expense_category_mapping[config['category']]
+        self.group_by = config.get('group_by', 'owner')
+        # Decision 中对应的字段，同一个字段只取第一条命中的规则
+        if self.action in ('skip', 'categorize'):
+            self.slot = 'fallback' if self.fallback else 'category'
+        else:
+            self.slot = self.action
+
+        # 用于建立哈希索引的完全匹配条件：(字段, 取值集合)
+        self.index_key = None
+        self.needs_time = False
+        self.predicates = []
+        for key, value in config.get('when', {}).items():
+            self.predicates.append(self._compile_predicate(key, value))
+
+    def _compile_predicate(self, key, value):
+        if key in MATCH_FIELDS:
+            values = frozenset([value] if isinstance(value, str) else value)
+            if self.index_key is None:
+                self.index_key = (key, values)
+            return lambda item, dt: getattr(item, key) in values
+        if key.endswith('_regex') and key[:-len('_regex')] in MATCH_FIELDS:
+            field = key[:-len('_regex')]
+            regex = re.compile(value)
+            return lambda item, dt: regex.match(getattr(item, field)) is not None
+        if key.endswith('_contains') and key[:-len('_contains')] in MATCH_FIELDS:
+            field = key[:-len('_contains')]
+            return lambda item, dt: value in getattr(item, field)
+        if key == 'weekday':
+            weekdays = frozenset(value)
+            self.needs_time = True
+            return lambda item, dt: dt.weekday() in weekdays
+        if key == 'hour':
+            hours = frozenset(value)
+            self.needs_time = True
+            return lambda item, dt: dt.hour in hours
+        raise ValueError("规则 {} 的条件无效: {}".format(self.index, key))
+
+    def matches(self, item, dt):
+        for predicate in self.predicates:
+            if not predicate(item, dt):
+                return False
+        return True
+
+class Decision:
+    """一个账单在决策表中命中的结果"""
+    __slots__ = ('category', 'fallback', 'merge', 'exclude')
+
+    def __init__(self):
+        self.category = None     # 合并前设置的分类
+        self.fallback = None     # 字典匹配失败后设置的分类
+        self.merge = None        # 命中的 merge 规则
+        self.exclude = None      # 命中的 exclude 规则
+
+    def merge_group(self, item):
+        if self.merge is None:
+            return None
+        return (self.merge.index, getattr(item, self.merge.group_by))
+
+EMPTY_DECISION = Decision()
+
+class RuleTable:
+    """规则编译成的决策表
+
+    带完全匹配条件的规则按 payee/item_name 建哈希索引，每个账单只需检查索引命中的规则
+    和没有完全匹配条件的规则，新增完全匹配规则几乎不增加开销
+    """
+
+    def __init__(self, rule_configs):
+        self.rules = [Rule(index, config) for index, config in enumerate(rule_configs)]
+        self.exact_index = {field: {} for field in MATCH_FIELDS}
+        self.scan_rules = []
+        for rule in self.rules:
+            if rule.index_key is None:
+                self.scan_rules.append(rule)
+                continue
+            field, values = rule.index_key
+            for value in values:
+                self.exact_index[field].setdefault(value, []).append(rule)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def candidates(self, item: BillItem):
+        payee_rules = self.exact_index['payee'].get(item.payee)
+        item_rules = self.exact_index['item_name'].get(item.item_name)
+        if not payee_rules and not item_rules:
+            return self.scan_rules
+        rules = self.scan_rules + (payee_rules or []) + (item_rules or [])
+        rules.sort(key=lambda rule: rule.index)
+        return rules
+
+    def evaluate(self, item: BillItem) -> Decision:
+        """没有命中任何规则时返回共享的 EMPTY_DECISION，不为每个账单分配对象"""
+        decision = EMPTY_DECISION
+        dt = None
+        for rule in self.candidates(item):
+            slot = rule.slot
+            if getattr(decision, slot) is not None:
+                continue
+            if rule.needs_time and dt is None:
+                dt = datetime.datetime.fromtimestamp(item.bill_time)
+            if not rule.matches(item, dt):
+                continue
+            if decision is EMPTY_DECISION:
+                decision = Decision()
+            if slot in ('category', 'fallback'):
+                setattr(decision, slot, rule.category)
+            else:
+                setattr(decision, slot, rule)
+        return decision
+
+def load_rule_table(rule_file):
+    if not rule_file:
+        return RuleTable([])
+    try:
+        with open(rule_file, 'r', encoding='utf-8') as f:
+            rule_configs = json.load(f).get('rules', [])
+    except FileNotFoundError:
+        logger.warning("规则文件不存在: {}".format(rule_file))
+        return RuleTable([])
+
+    rule_table = RuleTable(rule_configs)
+    logger.info("加载规则 {} 条: {}".format(len(rule_table), rule_file))
+    return rule_table
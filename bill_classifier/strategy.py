@@ -1,13 +1,17 @@
 import logging
 import re
-import datetime
 
 from feishu import FeishuSheetAPI
 from bill_item import BillType, BillItem, ClassifyAlg
 from typing import List
 from bill_config import BillConfig
-from category import ExpenseCategory, expense_category_mapping, CategoryInfo
+from category import ExpenseCategory, expense_category_mapping
 from classifier_gpt import GPTClassifier
+from classify_cache import create_classify_cache, normalize_text
+from classifier_local import load_local_classifier
+from example_index import load_example_index
+from category_index import load_category_index
+from rules import EMPTY_DECISION, load_rule_table
 
 logger = logging.getLogger(__name__)
 
@@ -15,153 +19,92 @@ BUY_VEGETABLES_TIME_RANGE = 3600
 
 def merge_refund_items(bill_item_list: List[BillItem]) -> List[BillItem]:
     logging.debug("合并退款账单 origin size:{}".format(len(bill_item_list)))
+    debug_enabled = logging.getLogger().isEnabledFor(logging.DEBUG)
     order_items = {}
-    merged_items = []
-    for item in bill_item_list:
+    # 记录每个账单是否保留在结果中，按输入顺序输出以保持时间顺序
+    keep_items = bytearray(len(bill_item_list))
+    for index, item in enumerate(bill_item_list):
         if not item.order_id:
             item.category = ExpenseCategory.SKIP
-            merged_items.append(item)
-            logging.debug("退款记录丢失原始账单: {}".format(item))
+            keep_items[index] = 1
+            if debug_enabled:
+                logging.debug("退款记录丢失原始账单: {}".format(item))
             continue
 
         if item.order_id not in order_items:
             order_items[item.order_id] = []
-        order_items[item.order_id].append(item)
+        order_items[item.order_id].append(index)
 
-    for order_id, items in order_items.items():
-        if len(items) == 1:
-            merged_items.append(items[0])
-        else:
-            # split the items into two lists: expense items and refund items
-            expense_items = []
-            refund_items = []
-            for item in items:
-                if item.bill_type == BillType.OTHER and '退款' in item.item_name:
-                    refund_items.append(item)
-                else:
-                    expense_items.append(item)
-
-            # merge expense items
-            debug_str = ''
-            if len(expense_items) > 0:
-                # expense items 有大于 1 的情况，例如淘宝的预付款&尾款订单就会有两条 order id 相同的 item
-                merged_item = expense_items[0]
-                debug_str = debug_str + str(expense_items[0].amount)
-                for item in expense_items[1:]:
-                    merged_item.amount += item.amount
-                    debug_str = debug_str + " + " + str(item.amount)
-
-                # refund expense items
-                for item in refund_items:
-                    merged_item.amount -= item.amount
-                    debug_str = debug_str + " - " + str(item.amount)
-
-                if merged_item.amount == 0.0:
-                    merged_item.category = ExpenseCategory.SKIP
-
-                merged_items.append(merged_item)
-                logging.debug("合并退款账单项: {} {} {} = {}".format(merged_item.order_id, merged_item.item_name, debug_str, merged_item.amount))
+    for order_id, indexes in order_items.items():
+        if len(indexes) == 1:
+            keep_items[indexes[0]] = 1
+            continue
+
+        # split the items into two lists: expense items and refund items
+        expense_indexes = []
+        refund_items = []
+        for index in indexes:
+            item = bill_item_list[index]
+            if item.bill_type == BillType.OTHER and '退款' in item.item_name:
+                refund_items.append(item)
             else:
-                for item in refund_items:
-                    merged_items.append(item)
-
-    return merged_items
-
-
-merge_payee_info = [
-    {
-        "pattern":"^余额宝.*收益发放$",
-        "col": "item_name",
-        "type": "regex"
-    },
-    {
-        "target": "北京轨道交通路网管理有限公司",
-        "col": "payee",
-        "type": "match"
-    },
-    {
-        "target": "北京金辉大厦烘焙店",
-        "col": "payee",
-        "type": "match"
-    },
-    {
-        "pattern": "^高德地图总部-美餐餐厅.*$",
-        "col": "payee",
-        "type": "regex"
-    },
-    {
-        "pattern": "^.*李邵男$",
-        "col": "payee",
-        "type": "regex"
-    }
-]
-
-def merge_items_strategy(bill_item_list: List[BillItem], merge_config: List[dict], group_by: str = "owner") -> List[BillItem]:
-    """
-    通用的账单项合并函数
-
-    Args:
-        bill_item_list: 账单列表
-        merge_config: 合并配置列表，每个配置项包含：
-            - "type": "regex" 或 "match"
-            - "col": 要匹配的字段名（如 "item_name", "payee"）
-            - "pattern": 正则表达式（type为"regex"时使用）
-            - "target": 匹配目标值（type为"match"时使用）
-        group_by: 分组字段名，默认为 "owner"
-
-    Returns:
-        合并后的账单列表
-    """
-    for config in merge_config:
-        col = config.get("col")
-        match_type = config.get("type")
-        if match_type == "regex":
-            pattern = config.get("pattern")
-        elif match_type == "match":
-            target = config.get("target")
-        else:
+                expense_indexes.append(index)
+
+        if len(expense_indexes) == 0:
+            for index in indexes:
+                keep_items[index] = 1
             continue
 
-        group_items = {}
-        last_items = []
-        for item in bill_item_list:
-            if item.category != ExpenseCategory.UNKNOWN:
-                last_items.append(item)
-                continue
+        # expense items 有大于 1 的情况，例如淘宝的预付款&尾款订单就会有两条 order id 相同的 item
+        expense_items = [bill_item_list[index] for index in expense_indexes]
+        merged_item = expense_items[0]
+        # 合计金额按分取整，避免浮点误差导致全额退款不等于 0
+        total_cents = round((sum(item.amount for item in expense_items) - sum(item.amount for item in refund_items)) * 100)
+        if debug_enabled:
+            debug_str = " + ".join(str(item.amount) for item in expense_items)
+            for item in refund_items:
+                debug_str = debug_str + " - " + str(item.amount)
+            logging.debug("合并退款账单项: {} {} {} = {}".format(merged_item.order_id, merged_item.item_name, debug_str, total_cents / 100))
 
-            if match_type == "regex":
-                if re.match(pattern, getattr(item, col)):
-                    if item.owner in group_items:
-                        group_items[item.owner].append(item)
-                    else:
-                        group_items[item.owner] = [item]
-                else:
-                    last_items.append(item)
-            elif match_type == "match":
-                if getattr(item, col) == target:
-                    if item.owner in group_items:
-                        group_items[item.owner].append(item)
-                    else:
-                        group_items[item.owner] = [item]
-                else:
-                    last_items.append(item)
-            else:
-                last_items.append(item)
+        merged_item.amount = total_cents / 100
+        if total_cents == 0:
+            merged_item.category = ExpenseCategory.SKIP
+        keep_items[expense_indexes[0]] = 1
 
-        for owner, items in group_items.items():
-            if len(items) == 0:
-                continue
-            merged_item = items[0]
-            total_amount = merged_item.amount
-            for item in items[1:]:
-                total_amount += item.amount
-            merged_item.amount = total_amount
-            logging.info(f"{owner} merge items {merged_item.payee}:{merged_item.item_name} for {len(items)}")
-            last_items.append(merged_item)
+    return [item for item, keep in zip(bill_item_list, keep_items) if keep]
+
+
+def merge_item_groups(bill_item_list: List[BillItem], find_group) -> List[BillItem]:
+    """按 find_group(item) 返回的分组 key 合并未分类的账单，返回 None 的账单不参与合并"""
+    group_items = {}
+    for item in bill_item_list:
+        if item.category != ExpenseCategory.UNKNOWN:
+            continue
 
-        bill_item_list = last_items
+        key = find_group(item)
+        if key is None:
+            continue
 
-    return bill_item_list
+        if key in group_items:
+            group_items[key].append(item)
+        else:
+            group_items[key] = [item]
+
+    if len(group_items) == 0:
+        return bill_item_list
+
+    # 合并后的账单留在组内第一条账单的位置，其余账单删除，列表的时间顺序保持不变
+    merged_ids = set()
+    for (_, group), items in group_items.items():
+        merged_item = items[0]
+        total_amount = merged_item.amount
+        for item in items[1:]:
+            total_amount += item.amount
+            merged_ids.add(id(item))
+        merged_item.amount = total_amount
+        logging.info(f"{group} merge items {merged_item.payee}:{merged_item.item_name} for {len(items)}")
+
+    return [item for item in bill_item_list if id(item) not in merged_ids]
 
 def merge_balance_items(bill_item_list: List[BillItem]) -> List[BillItem]:
     regex_pattern = r'^余额宝.*收益发放$'
@@ -192,37 +135,78 @@ def merge_balance_items(bill_item_list: List[BillItem]) -> List[BillItem]:
 
     return last_items
 
-def InitCategoryInfo(user_access_token: str, sheet_token: str):
-    category_info = CategoryInfo()
-
+def InitCategoryIndex(user_access_token: str, sheet_token: str, snapshot_file: str = '', index_file: str = ''):
     feishu_api = FeishuSheetAPI(user_access_token, sheet_token)
 
     range_name = '125297'
 
-    ret, category_info.payee_category_dict = feishu_api.GetCategoryClassificationInfo(range_name + '!A:B')
+    # 四个字典区域：完全匹配 payee、item_name，模糊匹配 payee、item_name
+    # 表格版本号未变化时直接加载编译好的索引，变化时一次请求读取四个区域并重新编译，飞书不可用时使用本地快照
+    ret, category_index = load_category_index(
+        feishu_api, [range_name + '!A:B', range_name + '!D:E', range_name + '!G:H', range_name + '!J:K'],
+        snapshot_file, index_file)
     if not ret:
         logging.error("获取分类信息失败")
-        return False, {}
+        return False, None
 
-    ret, category_info.item_category_dict = feishu_api.GetCategoryClassificationInfo(range_name + '!D:E')
-    if not ret:
-        logging.error("获取分类信息失败")
-        return False, {}
+    return True, category_index
 
-    ret, category_info.payee_category_regular_dict = feishu_api.GetCategoryClassificationInfo(range_name + '!G:H')
-    if not ret:
-        logging.error("获取分类信息失败")
-        return False, {}
 
-    ret, category_info.item_category_regular_dict = feishu_api.GetCategoryClassificationInfo(range_name + '!J:K')
-    if not ret:
-        logging.error("获取分类信息失败")
-        return False, {}
+def group_query(group):
+    """每组用第一条账单作为 GPT 查询"""
+    item = group[0]
+    return (item.item_name, item.payee, item.amount, item.bill_time)
+
+def group_value(group):
+    """组内账单金额之和，同时体现单笔金额和重复次数"""
+    return sum(abs(item.amount) for item in group)
 
-    return True, category_info
+def schedule_gpt_groups(groups, classifier, batch_size, call_limit, token_budget):
+    """按价值从高到低安排 GPT 查询，返回 (批次列表, 跳过的组, 预估 token 数)
 
+    call_limit 限制查询次数，token_budget 限制按提示词长度预估的 token 数（<=0 表示不限制）；
+    命中缓存的组不发请求，不占用额度
+    """
+    groups = sorted(groups, key=group_value, reverse=True)
+    batches = []
+    batch = []
+    cached_groups = []
+    skipped_groups = []
+    query_count = 0
+    estimated_tokens = 0
+    for group in groups:
+        item = group[0]
+        if classifier.is_cached(item.item_name, item.payee):
+            cached_groups.append(group)
+            continue
+        # 额度用完后只跳过价值更低的组，不再尝试塞进更便宜的查询
+        if skipped_groups or (call_limit >= 0 and query_count >= call_limit):
+            skipped_groups.append(group)
+            continue
+
+        if len(batch) == batch_size:
+            batches.append(batch)
+            batch = []
+        queries = [group_query(g) for g in batch]
+        cost = classifier.estimate_tokens(queries + [group_query(group)]) - classifier.estimate_tokens(queries)
+        if token_budget > 0 and estimated_tokens + cost > token_budget:
+            skipped_groups.append(group)
+            continue
+
+        batch.append(group)
+        query_count += 1
+        estimated_tokens += cost
+
+    if batch:
+        batches.append(batch)
+    batches.extend(cached_groups[i:i + batch_size] for i in range(0, len(cached_groups), batch_size))
+    return batches, skipped_groups, estimated_tokens
+
+def categorize_items(items: List[BillItem], bill_config: BillConfig, decisions=None) -> List[BillItem]:
+    """decisions: item -> 规则决策表的结果，只包含命中规则的账单，为 None 时不应用规则文件"""
+    if decisions is None:
+        decisions = {}
 
-def categorize_items(items: List[BillItem], bill_config: BillConfig) -> List[BillItem]:
     # debug info
     marked_item_count = 0
     mark_skip_count = 0
@@ -230,7 +214,10 @@ def categorize_items(items: List[BillItem], bill_config: BillConfig) -> List[Bil
 
     # set expense category for each item
     # 策略 1
-    ret, category_info = InitCategoryInfo(bill_config.feishu_config.user_access_token, bill_config.feishu_config.category_sheet_token)
+    ret, category_index = InitCategoryIndex(bill_config.feishu_config.user_access_token,
+                                            bill_config.feishu_config.category_sheet_token,
+                                            bill_config.strategy_config.category_snapshot_file,
+                                            bill_config.strategy_config.category_index_file)
     if not ret:
         logging.error("获取分类信息失败")
         return False
@@ -244,60 +231,29 @@ def categorize_items(items: List[BillItem], bill_config: BillConfig) -> List[Bil
             item.category = ExpenseCategory.SKIP
             continue
 
-        # 处理完全匹配
-        if item.item_name in category_info.item_category_dict:  # noqa: F405
-            item.category = category_info.item_category_dict[item.item_name]  # noqa: F405
-            item.classify_alg = ClassifyAlg.MATCH
+        # 完全匹配，其次模糊匹配（子串匹配）
+        category, classify_alg = category_index.classify(item.item_name, item.payee)
+        if category is not None:
+            item.category = category
+            item.classify_alg = classify_alg
             mark_count += 1
             continue
 
-        if item.payee in category_info.payee_category_dict:  # noqa: F405
-            item.category = category_info.payee_category_dict[item.payee]  # noqa: F405
-            item.classify_alg = ClassifyAlg.MATCH
-            mark_count += 1
-            continue
-
-        # 处理正则匹配
-        item_reg_match = False
-        for item_reg, category in category_info.item_category_regular_dict.items():  # noqa: F405
-            if item_reg in item.item_name:
-                item.category = category
-                item.classify_alg = ClassifyAlg.REGULAR
-                item_reg_match = True
-                mark_count += 1
-                break
-
-        if item_reg_match:
-            continue
-
-        payee_reg_match = False
-        for payee_reg, category in category_info.payee_category_regular_dict.items():  # noqa: F405
-            if payee_reg in item.payee:
-                item.category = category
-                item.classify_alg = ClassifyAlg.REGULAR
-                payee_reg_match = True
-                mark_count += 1
-                break
-
-        if payee_reg_match:
-            continue
-
     logging.debug("after regex match item size:{}".format(len(items)))
     logging.debug("计算 category 前已标记过 category 的 item size:{}".format(marked_item_count))
     logging.debug("计算 category 时标记为 skip 的 item size:{}".format(mark_skip_count))
     logging.debug("计算 category 时标记为有效值的 item size:{}".format(mark_count))
 
-    skip_items = [
-        "余额宝-自动转入",
-        "转账备注:微信转账"
-    ]
-
+    # 规则文件中 fallback 的 skip/categorize 规则
     extra_skip_count = 0
     for item in items:
         if item.category != ExpenseCategory.UNKNOWN:
             continue
-        if item.item_name in skip_items:
-            item.category = ExpenseCategory.SKIP
+        fallback = decisions.get(item, EMPTY_DECISION).fallback
+        if fallback is not None:
+            item.category = fallback
+            if fallback != ExpenseCategory.SKIP:
+                item.classify_alg = ClassifyAlg.MATCH
             extra_skip_count += 1
             continue
     logging.info("extra skip item size:{}".format(extra_skip_count))
@@ -337,78 +293,129 @@ def categorize_items(items: List[BillItem], bill_config: BillConfig) -> List[Bil
 
     logging.debug("时间段买菜标记 item size:{}".format(mark_count))
 
-    # 策略 3
+    # 策略 3: 用历史账单训练的本地模型分类，置信度不够的留给 GPT
     mark_count = 0
-    classifier = GPTClassifier(bill_config.gpt_config.api_key)
-    call_limit = bill_config.gpt_config.call_limit
-    for i, item in enumerate(items):
-        if call_limit >= 0 and mark_count == call_limit:
-            break
+    local_model = load_local_classifier(bill_config.strategy_config.local_model_file)
+    threshold = bill_config.strategy_config.local_model_threshold
+    if local_model is not None:
+        for item in items:
+            if item.category != ExpenseCategory.UNKNOWN:
+                continue
+            if decisions.get(item, EMPTY_DECISION).exclude is not None:
+                continue
 
-        if item.category != ExpenseCategory.UNKNOWN:
-            continue
+            text, confidence = local_model.predict(item.item_name, item.payee, item.amount)
+            if confidence < threshold or text not in expense_category_mapping:
+                continue
+            logging.debug("local classifier:{} {} -> {} {:.3f}".format(item.item_name, item.payee, text, confidence))
+            item.category = expense_category_mapping[text]
+            item.classify_alg = ClassifyAlg.LOCAL
+            mark_count += 1
+    logging.info("本地模型标记 item size:{}".format(mark_count))
 
-        # 过滤一些无法识别的数据
-        if item.payee == '美团' or item.payee == '美团平台商户':
+    # 策略 4
+    mark_count = 0
+    classifier = GPTClassifier(bill_config.gpt_config.api_key, base_url=bill_config.gpt_config.base_url,
+                               cache=create_classify_cache(bill_config.gpt_config),
+                               example_index=load_example_index(bill_config.gpt_config.example_index_file),
+                               example_count=bill_config.gpt_config.example_count)
+    call_limit = bill_config.gpt_config.call_limit
+    batch_size = max(1, bill_config.gpt_config.batch_size)
+    # 归一化后 item_name/payee 相同的账单只查询一次，结果应用到组内所有账单
+    gpt_groups = {}
+    for item in items:
+        if item.category != ExpenseCategory.UNKNOWN:
             continue
 
-        pattern = r"订单编号"
-        if item.payee == '京东' and re.search(pattern, item.item_name):
+        # 过滤规则文件中 exclude 的数据
+        if decisions.get(item, EMPTY_DECISION).exclude is not None:
             continue
 
-        text = classifier.call(item.item_name, item.payee, item.amount, item.bill_time)
-        logging.info("gpt classifier:{} {} -> {}".format(item.item_name, item.payee, text))
-        if len(text) == 0:
-            continue
+        key = (normalize_text(item.item_name), normalize_text(item.payee))
+        if key in gpt_groups:
+            gpt_groups[key].append(item)
+        else:
+            gpt_groups[key] = [item]
+
+    gpt_config = bill_config.gpt_config
+    batches, skipped_groups, estimated_tokens = schedule_gpt_groups(
+        list(gpt_groups.values()), classifier, batch_size, call_limit, gpt_config.token_budget)
+    logging.info("gpt unknown item size:{} query size:{}".format(sum(len(group) for group in gpt_groups.values()),
+                                                                 sum(len(batch) for batch in batches)))
+
+    # 每组用第一条账单作为查询，多条查询打包成一次请求，多个批次并发发出
+    results = classifier.classify_batches(
+        [[group_query(group) for group in batch] for batch in batches],
+        gpt_config.concurrency, gpt_config.requests_per_minute, gpt_config.tokens_per_minute, gpt_config.timeout)
+    # 按账单顺序应用结果，与请求完成的先后无关
+    for batch, texts in zip(batches, results):
+        for group, text in zip(batch, texts):
+            logging.info("gpt classifier:{} {} -> {} x{}".format(group[0].item_name, group[0].payee, text, len(group)))
+            if len(text) == 0:
+                continue
 
-        if text not in expense_category_mapping:
-            continue
+            if text not in expense_category_mapping:
+                continue
 
-        item.category = expense_category_mapping[text]
-        item.classify_alg = ClassifyAlg.GPT
-        mark_count += 1
-    logging.info("gpt cost token:{}".format(classifier.get_token_count()))
+            for item in group:
+                item.category = expense_category_mapping[text]
+                item.classify_alg = ClassifyAlg.GPT
+                mark_count += 1
+    classifier.save_cache()
+    logging.info("gpt cost token:{} cache {}".format(classifier.get_token_count(), classifier.get_cache_stats()))
+    budget = gpt_config.token_budget if gpt_config.token_budget > 0 else "unlimited"
+    logging.info("gpt budget: estimated {} / {} token, skipped {} query {} item, amount {:.2f}".format(
+        estimated_tokens, budget, len(skipped_groups), sum(len(group) for group in skipped_groups),
+        sum(group_value(group) for group in skipped_groups)))
     logging.debug("GPT标记 item size:{}".format(mark_count))
 
     return True
 
 
 
-def bill_strategy(bill_item_list, bill_config):
-    # 分析数据
-    # 如果 payee 正则匹配"高德地图总部-美餐餐厅"，且时间为工作日下午6点到7点，把category 标记为 skip
-    payee_pattern = r'^高德地图总部-美餐餐厅.*$'
-    mark_skip_count = 0
-    for item in bill_item_list:
-        # 检查payee是否匹配正则表达式
-        if not re.match(payee_pattern, item.payee):
-            continue
+def bill_strategy(bill_items, bill_config):
+    """bill_items 可以是列表，也可以是 load_bill_items() 归并出的 BillItem 流
 
-        # 检查是否为工作日且时间在18:00-19:00之间
-        dt = datetime.datetime.fromtimestamp(item.bill_time)
-        # weekday()返回0-6，0是周一，6是周日，所以工作日是<5
-        is_weekday = dt.weekday() < 5
-        # 下午6点到7点：18:00 <= time < 19:00 or 晚上9点到10点：21:00 <= time < 22:00
-        is_work_hour = dt.hour == 18 or dt.hour == 21
+    后续的合并策略都保持账单顺序不变，输入已按时间排序时不再做全量排序
+    """
+    # 规则文件编译成决策表，每个账单只在读入时求值一次
+    rule_table = load_rule_table(bill_config.strategy_config.rule_file)
 
-        if is_weekday and is_work_hour:
-            item.category = ExpenseCategory.SKIP
+    mark_skip_count = 0
+    bill_item_list = []
+    decisions = {}
+    is_sorted = True
+    for item in bill_items:
+        if bill_item_list and item.bill_time < bill_item_list[-1].bill_time:
+            is_sorted = False
+        bill_item_list.append(item)
+
+        decision = rule_table.evaluate(item)
+        if decision is EMPTY_DECISION:
+            continue
+        # 以账单对象为 key，字典持有账单的引用，合并删除的账单不会被回收后复用 id
+        decisions[item] = decision
+        if decision.category is not None:
+            item.category = decision.category
+            if decision.category != ExpenseCategory.SKIP:
+                item.classify_alg = ClassifyAlg.MATCH
             mark_skip_count += 1
 
-    logging.info("美餐餐厅工作日18点标记为skip的item数量:{}".format(mark_skip_count))
+    logging.info("规则文件标记分类的item数量:{}".format(mark_skip_count))
+
+    if not is_sorted:
+        bill_item_list.sort(key=lambda item: item.bill_time)
 
     # 合并策略
-    bill_item_list = merge_items_strategy(bill_item_list, merge_payee_info)
+    bill_item_list = merge_item_groups(bill_item_list, lambda item: decisions.get(item, EMPTY_DECISION).merge_group(item))
     logging.info("after merge payee bill item:{}".format(len(bill_item_list)))
-    bill_item_list = sorted(bill_item_list, key=lambda item: item.bill_time)
 
     # 合并退款
     bill_item_list = merge_refund_items(bill_item_list)
     logging.info("after merge refund bill item:{}".format(len(bill_item_list)))
-    bill_item_list = sorted(bill_item_list, key=lambda item: item.bill_time)
 
     # 划分到某个大类
-    ret = categorize_items(bill_item_list, bill_config)
+    ret = categorize_items(bill_item_list, bill_config, decisions)
     logging.info("after categorize bill item:{}".format(len(bill_item_list)))
 
     return ret, bill_item_list
@@ -2,16 +2,68 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import functools
 import time
 
 def is_chinese_equal(s1: str, s2: str) -> bool:
     """判断两个中文字符串是否相等，忽略空格"""
     return s1.strip().encode('utf-8') == s2.strip().encode('utf-8')
 
+@functools.lru_cache(maxsize=4096)
+def _date_epoch(date_str, sep):
+    """返回 'YYYY-MM-DD' 当天 0 点的本地时间戳
+
+    当天发生夏令时切换等导致一天不是 86400 秒时返回 None，由调用方回退到 datetime 计算
+    """
+    if date_str[4] != sep or date_str[7] != sep or not date_str.replace(sep, '').isdecimal():
+        return None
+    try:
+        day = datetime.datetime(int(date_str[0:4]), int(date_str[5:7]), int(date_str[8:10]))
+    except ValueError:
+        return None
+    start = day.timestamp()
+    if (day + datetime.timedelta(days=1)).timestamp() - start != 86400:
+        return None
+    return start
+
+def _fast_timestamp(time_str, sep, with_second):
+    """按固定位置切片解析 'YYYY-MM-DD HH:MM:SS' / 'YYYY/MM/DD HH:MM'，格式不符时返回 None"""
+    if len(time_str) != (19 if with_second else 16) or time_str[10] != ' ' or time_str[13] != ':':
+        return None
+    start = _date_epoch(time_str[:10], sep)
+    if start is None:
+        return None
+    hour = time_str[11:13]
+    minute = time_str[14:16]
+    if not (hour.isdecimal() and minute.isdecimal()):
+        return None
+    second = 0
+    if with_second:
+        if time_str[16] != ':' or not time_str[17:19].isdecimal():
+            return None
+        second = int(time_str[17:19])
+    hour = int(hour)
+    minute = int(minute)
+    if hour > 23 or minute > 59 or second > 59:
+        return None
+    return start + hour * 3600 + minute * 60 + second
+
+_FAST_TIME_FORMATS = {
+    "%Y-%m-%d %H:%M:%S": ('-', True),
+    "%Y/%m/%d %H:%M": ('/', False),
+}
+
 def str2timestamp(time_str, time_format):
     if len(time_str) == 0:
         return time.time()
 
+    # 已知的账单时间格式走固定位置解析，结果与 strptime + timestamp() 一致
+    fast_format = _FAST_TIME_FORMATS.get(time_format)
+    if fast_format is not None:
+        timestamp = _fast_timestamp(time_str, *fast_format)
+        if timestamp is not None:
+            return timestamp
+
     dt_obj = datetime.datetime.strptime(time_str, time_format)
     return dt_obj.timestamp()
 